@@ -19,13 +19,9 @@ from keras.utils import to_categorical
 from keras.layers.merge import concatenate
 import matplotlib.pyplot as plt
 # load in MNIST
-(x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-#print(x_train.shape) # 60000 28 28
-x_train = x_train.astype('float32') / 255
-x_test = x_test.astype('float32') / 255
-x_train = x_train.reshape((len(x_train), np.prod(x_train.shape[1:]))) # 60000, 784
-# print(x_train.shape) # 600000 784
-x_test = x_test.reshape((len(x_test), np.prod(x_test.shape[1:]))) # 10000, 784 
+from mnist_data import load_mnist, mnist_dataset, scale_batch
+(x_train, y_train), (x_test, y_test) = load_mnist() # uint8 memmaps, 60000 28 28
+x_test = scale_batch(x_test, (784,)) # 10000, 784, small enough to scale once for the plots
 print(x_test.shape)
 # convert y to onehot
 plot_labels_test = y_test
@@ -40,10 +36,10 @@ batch_size = 128
 intermediate_dim = 64
 latent_dim = 2
 n_y = y_train.shape[1] # 10
-n_x = x_train.shape[1] # 784
+n_x = x_test.shape[1] # 784
 print(n_y, n_x) # 10 784
 print(y_train[1].shape) # 10,
-print(x_train.shape, x_train[1].shape) # 60000, 784) (784,)
+print(x_train.shape, x_test[1].shape) # (60000, 28, 28) (784,)
 n_z = 2
 
 # Make a sampling layer, this maps the MNIST digit to latent-space triplet (z_mean, z_log_var, z), this is how the bottleneck is displayed. 
@@ -122,7 +118,9 @@ tensorboard_callback = TensorBoard(log_dir=log_dir)
 es_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=6)
 
 # fit the data to MNIST
-history = cvae.fit([x_train, y_train], x_train, epochs=epochs, batch_size=batch_size, validation_data = ([x_test, y_test], x_test), verbose = 2, callbacks=[tensorboard_callback, es_callback])
+train_ds = mnist_dataset(x_train, plot_labels_train, batch_size=batch_size) # training batches are scaled to float32 as they're read
+val_ds = mnist_dataset(x_test, plot_labels_test, batch_size=batch_size, shuffle=False)
+history = cvae.fit(train_ds, epochs=epochs, validation_data=val_ds, verbose = 2, callbacks=[tensorboard_callback, es_callback])
 print(history.history.keys())
 
 
@@ -13,7 +13,7 @@ import pandas as pd
 
 def plot_clusters(encoder, x_test, y_test, labels, batch_size):
     ''' Display how the latent space clusters the digit classes '''
-    x_test_encoded, _, _, _ = encoder.predict([x_test, y_test], batch_size=batch_size)
+    x_test_encoded, _, _, _ = encoder.predict([np.asarray(x_test), y_test], batch_size=batch_size)
     fig = plt.figure(figsize=(6, 6))
     plt.scatter(x_test_encoded[:, 0], x_test_encoded[:, 1], c=labels)
     plt.colorbar()
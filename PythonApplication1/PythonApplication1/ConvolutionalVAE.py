@@ -85,13 +85,12 @@ vae.add_loss(vae_loss)
 vae.compile(optimizer=keras.optimizers.Adam())
 
 # train VAE on MNIST
-(x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-# reshaping the data (google why this way)
-x_train = np.reshape(x_train, (len(x_train), 28, 28, 1))
-x_test = np.reshape(x_test, (len(x_test), 28, 28, 1))
-# then changing the data type and making pixel values between 1 and 0
-x_train = x_train.astype('float32') / 255
-x_test = x_test.astype('float32') / 255
+from mnist_data import load_mnist, mnist_dataset, scale_batch
+(x_train, y_train), (x_test, y_test) = load_mnist()
+# batches are reshaped to 28, 28, 1 and scaled to between 0 and 1 as they're read
+train_ds = mnist_dataset(x_train, batch_size=batch_size, shape=(28, 28, 1))
+val_ds = mnist_dataset(x_test, batch_size=batch_size, shape=(28, 28, 1), shuffle=False)
+x_test = scale_batch(x_test, (28, 28, 1))
 print(x_train.shape, x_test.shape)                 
 #vae = VAE(encoder, decoder)
 #vae_output = decoder(encoder(encoder_inputs)[2])
@@ -107,7 +106,7 @@ tensorboard_callback = TensorBoard(log_dir=log_dir)
 es_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=6)
 
 
-history = vae.fit(x_train, x_train, batch_size= batch_size, epochs=epochs, verbose = 2, callbacks=[tensorboard_callback, es_callback], validation_data=(x_test,x_test))
+history = vae.fit(train_ds, epochs=epochs, verbose = 2, callbacks=[tensorboard_callback, es_callback], validation_data=val_ds)
 # .fit function returns history object with loss metrics
 print(history.history.keys())
 
@@ -185,8 +184,7 @@ def plot_label_clusters(encoder, data, labels):
     #plt.show()
 
 
-(x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-x_train = np.expand_dims(x_train, -1).astype("float32") / 255
+x_train = scale_batch(x_train, (28, 28, 1))
 
 plot_label_clusters(encoder, x_train, y_train)
 
@@ -12,17 +12,13 @@ if gpus:
         # Memory growth must be set before GPUs have been initialized
         print(e)
 
-import numpy as np
 from tensorflow import keras
-from tensorflow.keras import layers
 from keras.utils import to_categorical
-from keras.layers.merge import concatenate
 import matplotlib.pyplot as plt
 import pandas as pd
 import math
 import glob
 import matplotlib.pyplot as plt
-import nibabel as nib #reading MR images
 
 filepath_df = pd.read_csv('Z:/PRONIA_data/Tables/pronia_full_niftis.csv')
 
@@ -33,22 +29,35 @@ mri_types =['wp0', # whole brain
             'rp1', # gm mask
             'rp2'] # wm mask
 
-niis = []
-labels = []
 num_subjs =698 # max 698
-
-# Read in MRI image stacks
-for i in range(num_subjs):
-    row = filepath_df.iloc[i]
-    nii_path = row['wp1']
-    nii = nib.load(nii_path)
-    nii = nii.get_fdata()
-    nii = nii[:, 101:117, :] # gives 16 slices 36-51, ones with most variance (<80% similarity) (detailed in slice_variance.csv)
-    labels.append(row['STUDYGROUP'])
-    for j in range(nii.shape[1]):
-        niis.append((nii[:,j,:]))
-        
-depth = len(nii[2])
+workers = 8 # threads reading niftis in parallel
+modalities = 'wp1' # a list e.g. ['wp1', 'wp2'] stacks them as channels, inchannel follows
+cache_dir = 'C:/Users/Mischa/sophie/cohort_cache' # preprocessed cohorts, delete to force a reload
+model_dir = 'C:/Users/Mischa/sophie/models/MRI_CVAE' # normalisation stats are saved here with the model
+index_path = 'C:/Users/Mischa/sophie/pronia_index.json' # header-only index of every nifti in the csv
+
+# Checking every file's header first (only changed files are re-read) and dropping rows that can't be loaded
+from mri_manifest import build_manifest, valid_cohort
+manifest = build_manifest(filepath_df, index_path, mri_types, workers=16)
+filepath_df = valid_cohort(filepath_df, manifest, modalities)
+num_subjs = min(num_subjs, len(filepath_df))
+
+# Read in MRI image stacks, the mri_cvae roi is slices 101:117, 16 slices with most variance (<80% similarity) (detailed in slice_variance.csv)
+# cropped to 20:60, 50:90 on each slice (the 'brain' roi is the whole brain), see mri_roi.rois
+roi = 'mri_cvae'
+from mri_roi import roi_args
+# min-max normalised to rescale between 1 and 0, loaded from the cache if this config has been run before
+from mri_cache import cached_cohort, cached_mask
+store = None # 'uint8' or 'float16' keeps the cohort quantised (a quarter / half the memory), dequantised to float32 a batch at a time, see mri_quantise
+sparse = None # e.g. (8, 8, 8) keeps only the 8*8*8 blocks with brain in them on disk, a fraction of the reads for big rois, see mri_sparse
+images, labels, norm_stats = cached_cohort(filepath_df, num_subjs, cache_dir, mri_type=modalities, **roi_args(roi), normalise='minmax', workers=workers, return_stats=True, quantise=store, sparse=sparse) # num_subjs,depth,40,40(,channels) float32
+mask_loss = False # True scores the reconstruction only inside the rp1/rp2 brain masks, the background doesn't dilute the loss (mri_cache.cached_mask)
+masks = cached_mask(filepath_df, num_subjs, cache_dir, **roi_args(roi), workers=workers) if mask_loss else None
+depth = images.shape[1]
+from mri_cache import cohort_key
+cache_key, _ = cohort_key(filepath_df, num_subjs, modalities, **roi_args(roi)) # the cache entry images came from, saved with the run
+from mri_stats import save_stats
+save_stats(norm_stats, model_dir) # min and max of the training cohort, load_stats(model_dir) to normalise new subjects the same way
 print(labels)
 # Prepare to crop images
 #def crop_center(img,cropx,cropy):
@@ -56,21 +65,6 @@ print(labels)
 #    startx = x//2-(cropx//220) # // means floor division (rounds down to whole number)
 #    starty = y//2-(cropy//2)    
 #    return img[starty:starty+cropy,startx:startx+cropx]
-# crop images in niis list
-images = []
-for i in range(len(niis)):
-    img = niis[i]
-    img = img[20:60, 50:90] # 12:108, 2:98 is whole brain
-    images.append(img)
-    
-images = np.asarray(images) # shape num_subjs*121*121
-# reshape to matrix in able to feed into network
-images = images.reshape(-1, depth, 40, 40) # num_subjs,depth,121,121, (96,96)
-
-### min-max normalisation to rescale between 1 and 0 to improve accuracy
-m = np.max(images)
-mi = np.min(images) 
-images = (images - mi) / (m - mi)
 
 # Normalise y for patient ages
 #m = np.max(labels)
@@ -86,15 +80,19 @@ images = (images - mi) / (m - mi)
 #images = temp # dim now 5*2*124*124 # could replace temp with images 
 
 # test train split (no labels for vae)
-from sklearn.model_selection import train_test_split
-x_train,x_test,y_train,y_test = train_test_split(images, labels, test_size=0.2, random_state=13)
-train_label, test_label = y_train, y_test
-y_train = to_categorical(y_train) # tuple num_patients * num_labels convert to onehot
-y_test = to_categorical(y_test) # tuple num_patients * num_labels
+# split as indices saved with the model (same partition every run and in the analysis), x_train/x_test are views over images, nothing is copied
+import os
+from mri_split import split_or_load, CohortView
+train_idx, test_idx, _ = split_or_load(os.path.join(model_dir, 'split.npz'), labels, test_size=0.2, random_state=13, stratify=False)
+x_train, x_test = CohortView(images, train_idx), CohortView(images, test_idx)
+train_label, test_label = [labels[i] for i in train_idx], [labels[i] for i in test_idx]
+y_train = to_categorical(train_label) # tuple num_patients * num_labels convert to onehot
+y_test = to_categorical(test_label) # tuple num_patients * num_labels
 # Y 0- healthy, 1- at risk, 2- recent depression, 4 - recent scz
  # Autoencoder variables
 epochs = 50
-batch_size = 8
+batch_size = 8 # effective batch, raise it with accumulate_steps to keep the same memory
+accumulate_steps = 1 # micro-batches per batch (batch_size / accumulate_steps at a time), e.g. batch_size = 64, accumulate_steps = 8, see benchmark_accumulation.py
 #intermediate_dim = 124
 latent_dim =50
 n_y = y_train.shape[1] # 2
@@ -102,79 +100,16 @@ n_y = y_train.shape[1] # 2
 n_x = x_train.shape[1] # 784
 n_z = 2 # depth?
 X, y = len(images[0][0][0]), len(images[0][0][0]) # should be 96, 96 messy fix though
-inchannel = 1
+inchannel = images.shape[4] if images.ndim == 5 else 1 # one channel per modality
 origin_dim = 28*15 # why is this set
 
 
-# Make a sampling layer, this maps the MNIST digit to latent-space triplet (z_mean, z_log_var, z), this is how the bottleneck is displayed. 
-from keras import backend as K
-def sampling(args):
-    """Uses (z_mean, z_log_var) to sample z, the vector encoding a digit."""
-    z_mean, z_log_sigma = args
-    epsilon = K.random_normal(shape=(K.shape(z_mean)[0], latent_dim), mean = 0., stddev=0.1)
-    return z_mean + K.exp(z_log_sigma) * epsilon
-
-# Build the model
-from tensorflow.keras.layers import Input, BatchNormalization, Conv3D, Dense, Flatten, Lambda, Reshape, Conv3DTranspose, BatchNormalization, SpatialDropout3D, Dropout
-# Encoder
-label = keras.Input(shape=(n_y, )) # shape of length y_train
-encoder_inputs = keras.Input(shape=(depth, X, y, inchannel)) # it will add a None layer as batch size
-x = layers.Conv3D(32, (3, 3, 3), activation="relu", padding="same")(encoder_inputs) # relu turns negative values to 0
-x = layers.MaxPooling3D(pool_size=(2, 2, 2))(x) # max pooling 
-#x = layers.SpatialDropout3D(0.3)(x)
-x = layers.Conv3D(64, (3, 3, 3), activation="relu",  padding="same")(x)
-x = layers.MaxPooling3D(pool_size=(2, 2, 2), padding ='same')(x) 
-x = layers.SpatialDropout3D(0.3)(x)
-x = layers.Conv3D(128, (3, 3, 3), activation="relu",  padding="same")(x)
-x = layers.MaxPooling3D(pool_size=(2, 2, 2), padding='same')(x) 
-#x = layers.SpatialDropout3D(0.3)(x)
-#x = layers.Conv3D(256, (3, 3, 3), activation="relu",  padding="same")(x)
-x = layers.Flatten()(x) # to feed into sampling function
-z_mean = layers.Dense(latent_dim, name="z_mean")(x)
-z_log_sigma = layers.Dense(latent_dim, name="z_log_var")(x)
-z = layers.Lambda(sampling, name='z')([z_mean, z_log_sigma])
-z_label = concatenate([z, label], name='encoded') 
-## initiating the encoder, it ouputs the latent dim dimensions
-encoder = keras.Model([encoder_inputs, label], [z_mean, z_log_sigma, z_label, z], name="encoder")
-encoder.summary()
-
-#### Make the decoder, takes the latent keras
-latent_inputs = keras.Input(shape=(latent_dim + n_y),) # changes based on depth 
-x =  layers.Dense(2*5*5*128, activation='relu')(latent_inputs)
-x = layers.Reshape((2, 5, 5, 128))(x)
-#x = layers.UpSampling3D((2,2,2))(x)
-#x = layers.Conv3DTranspose(128, (3, 3, 3), activation="relu", padding="same")(x)
-x = layers.UpSampling3D((2,2,2))(x)
-x = layers.Conv3DTranspose(64, (3, 3, 3), activation="relu",  padding="same")(x)
-x = layers.SpatialDropout3D(0.3)(x)
-x = layers.UpSampling3D((2,2,2))(x)
-#x = layers.SpatialDropout3D(0.2)(x)
-x = layers.Conv3DTranspose(32, (3, 3, 3), activation="relu",  padding="same")(x)
-x = layers.UpSampling3D((2,2,2))(x)
-#x = layers.SpatialDropout3D(0.3)(x)
-decoder_outputs = layers.Conv3DTranspose(1, 3, activation="sigmoid", padding="same")(x)
-# Initiate decoder
-decoder = keras.Model(latent_inputs, decoder_outputs, name="decoder")
-decoder.summary()
-
-# Instantiate and fit VAE model, outputs only z_label
-outputs = decoder(encoder([encoder_inputs, label])[2])
-cvae = keras.Model([encoder_inputs, label], outputs, name='cvae')
-cvae.summary()
-
-# use a custom loss function, this includes a KL divergence regularisation term which ensures that z is close to normal (0 mean, 1 sd)
-reconstruction_loss = keras.losses.binary_crossentropy(encoder_inputs, outputs)
-reconstruction_loss *= origin_dim # how does this impact model
-reconstruction_loss = K.mean(reconstruction_loss) # mean to avoid incompatible shape error
-kl_loss = 1 + z_log_sigma - K.square(z_mean) - K.exp(z_log_sigma)
-kl_loss = K.sum(kl_loss, axis=-1)
-kl_loss *= -0.5
-cvae_loss = reconstruction_loss + kl_loss # mean was worse
-
-# Add loss and compile cvae model
-cvae.add_loss(cvae_loss)
-opt = keras.optimizers.Adam(learning_rate = 0.001, beta_1 = 0.009)
-cvae.compile(optimizer=opt)
+# Build the model, the settings are saved with the run so mri_registry.load_run can rebuild it and load the weights
+from mri_cvae_model import build_cvae, training_mode
+train_mode = 'float32' # 'xla', 'bf16' or 'xla_bf16', run benchmark_training.py on the training machine to see which is faster without changing val_loss
+model_config = {'depth': depth, 'rows': X, 'cols': y, 'inchannel': inchannel, 'n_y': n_y, 'latent_dim': latent_dim, 'origin_dim': origin_dim}
+models = build_cvae(**model_config, accumulate_steps=accumulate_steps, **training_mode(train_mode))
+encoder, decoder, cvae = models['encoder'], models['decoder'], models['cvae']
 
 # Tensorboard
 from keras.callbacks import TensorBoard
@@ -185,8 +120,52 @@ tensorboard_callback = TensorBoard(log_dir=log_dir)
 # Adding early stopping
 es_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=10)
 
+# Streaming float32 batches (shuffled each epoch, prefetched) and timing how long each epoch waits on them
+from mri_pipeline import cohort_dataset, InputStallTimer
+use_tfrecords = False # True trains from sharded tfrecords exported once per cohort/split (to tfrecord_dir), read back in parallel
+tfrecord_dir = 'C:/Users/Mischa/sophie/tfrecords/MRI_CVAE'
+if use_tfrecords and not mask_loss: # the tfrecords carry no masks
+    from mri_tfrecord import export_tfrecords, tfrecord_dataset
+    first_type = modalities if isinstance(modalities, str) else modalities[0]
+    subject_ids = [os.path.basename(p) for p in filepath_df[first_type][:num_subjs]]
+    export_tfrecords(tfrecord_dir, images, labels, train_idx, 'train', cache_key, subject_ids)
+    export_tfrecords(tfrecord_dir, images, labels, test_idx, 'test', cache_key, subject_ids)
+    train_ds = tfrecord_dataset(tfrecord_dir, 'train', batch_size, num_classes=n_y, shuffle=True)
+    val_ds = tfrecord_dataset(tfrecord_dir, 'test', batch_size, num_classes=n_y, shuffle=False)
+else:
+    train_ds = cohort_dataset(images, labels, batch_size, num_classes=n_y, shuffle=True, indices=train_idx, masks=masks) # batches gathered from images by index
+    val_ds = cohort_dataset(images, labels, batch_size, num_classes=n_y, shuffle=False, indices=test_idx, masks=masks)
+augment = False # True adds random flips, affine/elastic jitter and intensity scaling of the training batches, done on the cpu while the model trains (val_loss is then not comparable with unaugmented runs)
+if augment:
+    from mri_augment import Augmenter, augment_dataset
+    train_ds = augment_dataset(train_ds, Augmenter(clip=(0., 1.), workers=workers), seed=13)
+stall_callback = InputStallTimer()
+coarse_to_fine = [] # e.g. [(6., 20), (3., 20)], 20 epochs at 6mm (64x fewer voxels) then 20 at 3mm (8x) from the 1.5mm niftis, see mri_multires
+
+# checkpoint every epoch in the background (last 3 + best val_loss kept), re-running the script after an interruption carries on from the latest one
+# the checkpoints are kept per config (a changed model or cohort starts fresh) and cleared once the run is saved
+from mri_checkpoint import TrainingCheckpoint, checkpoint_dir, clear_checkpoints
+ckpt_config = {'model': model_config, 'cache_key': cache_key, 'batch_size': batch_size, 'accumulate_steps': accumulate_steps, 'train_mode': train_mode,
+               'mask_loss': mask_loss, 'augment': augment, 'coarse_to_fine': coarse_to_fine}
+ckpt_callback = TrainingCheckpoint(checkpoint_dir(model_dir, ckpt_config), cvae, early_stopping=es_callback, keep_last=3)
+initial_epoch = ckpt_callback.restore()
+
+# coarse to fine (set above), warm up on the cohort resampled to bigger voxels (cached next to the full resolution images) then the epochs below fine tune at full resolution
+if coarse_to_fine and initial_epoch == 0: # a resumed run had its warm up already
+    from mri_multires import warm_up
+    warm_up(models, coarse_to_fine, lambda voxel: cached_cohort(filepath_df, num_subjs, cache_dir, mri_type=modalities, **roi_args(roi), normalise='minmax', workers=workers, quantise=store, sparse=sparse, resample=voxel)[0],
+            labels, model_config, train_idx, test_idx, batch_size, build_kwargs=dict(accumulate_steps=accumulate_steps, **training_mode(train_mode)))
+
 # fit the data 
-history = cvae.fit([x_train, y_train], x_train, epochs=epochs, batch_size=batch_size, validation_data = ([x_test, y_test], x_test), verbose = 2, callbacks=[tensorboard_callback, es_callback])
+history = cvae.fit(train_ds, epochs=epochs, initial_epoch=initial_epoch, validation_data = val_ds, verbose = 2, callbacks=[tensorboard_callback, es_callback, stall_callback, ckpt_callback]) # ckpt_callback after es_callback
+
+# save the weights with everything needed to get back here (Wrapper.py loads this instead of retraining), not if fit had no epochs left to run
+from mri_registry import save_run
+if history.epoch:
+    save_run(model_dir, models, {'data': {'csv': 'Z:/PRONIA_data/Tables/pronia_full_niftis.csv', 'num_subjs': num_subjs, 'modalities': modalities, 'roi': roi,
+                                          'normalise': 'minmax', 'cache_dir': cache_dir, 'cache_key': cache_key, 'quantise': store, 'sparse': sparse},
+                                 'model': model_config, 'train': {'epochs': epochs, 'batch_size': batch_size, 'accumulate_steps': accumulate_steps, 'coarse_to_fine': coarse_to_fine}}, history)
+    clear_checkpoints(model_dir) # the run is saved, a re-run trains afresh
 
 ####################
 
@@ -44,17 +44,11 @@ mri_types =['wp0', # whole brain
             'rp2'] # wm mask
 
 num_subjs = 100 # max 698
-niis = []
+workers = 8 # threads reading niftis in parallel
 
-import nibabel as nib #reading MR images
-for i in range(num_subjs):
-    row = filepath_df.iloc[i]
-    nii_path = row['wp0']
-    nii = nib.load(nii_path)
-    nii = nii.get_fdata()
-    nii = nii[:, 78:80, :]
-    for j in range(nii.shape[1]):
-        niis.append((nii[:,j,:]))
+from mri_loader import load_cohort
+from mri_roi import roi_args
+images, _ = load_cohort(filepath_df, num_subjs, mri_type='wp0', **roi_args('mri_vae'), workers=workers) # slices 78:80, num_subjs,depth,124,124 zero padded
 
 
 ## Set autoencoder variables
@@ -65,25 +59,20 @@ latent_dim = 200 # compressing image to something
 batch_size = 16
 inchannel = 1
 X, y = 124, 124
-depth = len(nii[2]) # the number of slices set above
+depth = images.shape[1] # the number of slices set above
 origin_dim = 28*28 # maybe change this?
 
 
 
 ## Preprocessing
-images = np.asarray(niis) # shape num_subjs*121*121
-
-# reshape to matrix in able to feed into network
-images = images.reshape(-1, depth, 121, 121) # num_subjs,depth,121,121,
-### min-max normalisation to rescale between 1 and 0 to improve accuracy
-m = np.max(images)
-mi = np.min(images) 
-images = (images - mi) / (m - mi)
-## Pad images with zeros at boundaries so the dimenson is even and easier to downsample images by two while passing through model. Add in three rows and columns to make dim 176*176
-temp = np.zeros([num_subjs, depth,124,124])
-temp[:,:,3:,3:,] = images
-print(images.shape)
-images = temp # dim now 5*2*124*124 # could replace temp with images 
+## Images are padded with zeros at boundaries by the loader so the dimenson is even and easier to downsample images by two while passing through model. Three rows and columns make dim 124*124
+### min-max normalisation to rescale between 1 and 0 to improve accuracy, done in place on the unpadded part
+brain = images[:, :, 3:, 3:]
+m = np.max(brain)
+mi = np.min(brain) 
+brain -= mi
+brain /= (m - mi)
+print(images.shape) # num_subjs, depth, 124, 124
 
 # test train split (no labels for vae)
 from sklearn.model_selection import train_test_split
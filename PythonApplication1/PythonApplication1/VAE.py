@@ -68,14 +68,14 @@ vae.add_loss(vae_loss)
 vae.compile(optimizer=keras.optimizers.Adam())
 
 # train VAE on MNIST
-(x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-x_train = x_train.astype('float32') / 255
-x_test = x_test.astype('float32') / 255
-x_train = x_train.reshape((len(x_train), np.prod(x_train.shape[1:])))
-x_test = x_test.reshape((len(x_test), np.prod(x_test.shape[1:])))
+from mnist_data import load_mnist, mnist_dataset, scale_batch
+(x_train, y_train), (x_test, y_test) = load_mnist()
+train_ds = mnist_dataset(x_train, batch_size=batch_size) # uint8 batches scaled to float32 as they're read
+val_ds = mnist_dataset(x_test, batch_size=batch_size, shuffle=False)
+x_test = scale_batch(x_test, (784,))
 print(x_test.shape)
 # fit the data
-vae.fit(x_train, x_train, epochs=epochs, batch_size=batch_size, validation_data = (x_test, x_test))
+vae.fit(train_ds, epochs=epochs, validation_data=val_ds)
 
 # Display how the latent space clusters the digit classes
 import matplotlib.pyplot as plt
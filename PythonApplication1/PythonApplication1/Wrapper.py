@@ -10,7 +10,12 @@ import nibabel as nib #reading MR images
 import tensorflow as tf
 from tensorflow import keras
 
-import MRI_CVAE as cvae
+import os
+# the trained model and its cached cohort, loaded in seconds (MRI_CVAE.py is only run if there's no saved run, or retrain = True)
+from mri_registry import load_or_train
+from mri_cvae_model import build_cvae
+retrain = False
+cvae = load_or_train('C:/Users/Mischa/sophie/models/MRI_CVAE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MRI_CVAE.py'), build_cvae, retrain=retrain)
 
 # input data analysis
 
@@ -28,7 +33,7 @@ from CVAE_3Dplots import reconstruction_plot, lossplot
 #reconstruction_plot_old(cvae.x_test, cvae.y_test, cvae.cvae, slice=2) # plot
 reconstruction_plot(cvae.x_test, cvae.y_test, cvae.cvae) # superior plot
 #lossplot(cvae.history) # plot [not working but not erroring
-prediction = cvae.cvae.predict([cvae.x_test, cvae.y_test]) # 
+prediction = cvae.cvae.predict([np.asarray(cvae.x_test), cvae.y_test]) # 
 sliceview(prediction[0])
 
 # Comparing variation between input and prediction data
@@ -0,0 +1,43 @@
+import sys
+import json
+import numpy as np
+import pandas as pd
+from benchmark_common import synthetic_cohort, peak_rss_mb, gpu_peak_mb, timer, samples_per_s, run_child
+## Benchmark of gradient accumulation (build_cvae(accumulate_steps=K)), peak memory and throughput against the batch size it's standing in for ##
+## Trains the MRI_CVAE model on the synthetic cohort (benchmark_common), each (batch_size, accumulate_steps) in a fresh python process so its peak memory is its own ##
+## micro_batch = batch_size / accumulate_steps is what's in memory at once, peak memory should follow micro_batch and not batch_size ##
+## peak_rss_mb is the process high water mark (includes tensorflow itself and the cohort), gpu_peak_mb the device's if there is a gpu ##
+# run: python benchmark_accumulation.py [num_subjs=256] [epochs=3] [roi=mri_cvae]
+
+configs = [(8, 1), (64, 1), (64, 8), (256, 1), (256, 32)] # (batch_size, accumulate_steps)
+
+def run_config(num_subjs, epochs, roi, batch_size, accumulate_steps):
+    ''' trains for epochs with one batch_size / accumulate_steps and returns the measurements '''
+    from tensorflow import keras
+    from mri_roi import roi_shape
+    from mri_cvae_model import build_cvae
+    from mri_pipeline import cohort_dataset
+    keras.utils.set_random_seed(13)
+    shape = roi_shape(roi)
+    images, labels = synthetic_cohort(num_subjs, shape)
+    train_idx = np.arange(num_subjs)
+    models = build_cvae(*shape, inchannel=1, n_y=5, accumulate_steps=accumulate_steps, summary=False)
+    train_ds = cohort_dataset(images, labels, batch_size, num_classes=5, shuffle=True, indices=train_idx).cache()
+    before = peak_rss_mb()
+    epoch_timer = timer('epoch')
+    history = models['cvae'].fit(train_ds, epochs=epochs, verbose=0, callbacks=[epoch_timer])
+    return {'batch_size': batch_size, 'accumulate_steps': accumulate_steps, 'micro_batch': -(-batch_size // accumulate_steps),
+            'updates_per_epoch': -(-num_subjs // batch_size), 'samples_per_s': samples_per_s(epoch_timer.times, num_subjs),
+            'peak_rss_mb': peak_rss_mb(), 'training_rss_mb': peak_rss_mb() - before, 'gpu_peak_mb': gpu_peak_mb(), 'final_loss': history.history['loss'][-1]}
+
+if __name__ == '__main__':
+    num_subjs = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    epochs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    roi = sys.argv[3] if len(sys.argv) > 3 else 'mri_cvae'
+    if len(sys.argv) > 5: # child process, one config
+        print(json.dumps(run_config(num_subjs, epochs, roi, int(sys.argv[4]), int(sys.argv[5]))))
+    else:
+        results = pd.DataFrame([run_child(__file__, num_subjs, epochs, roi, batch_size, accumulate_steps) for batch_size, accumulate_steps in configs])
+        results = results.set_index(['batch_size', 'accumulate_steps'])
+        results['throughput_vs_batch_8'] = results['samples_per_s'] / results['samples_per_s'].iloc[0]
+        print(results.round(3).to_string())
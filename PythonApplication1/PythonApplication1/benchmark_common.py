@@ -0,0 +1,63 @@
+import sys
+import os
+import json
+import time
+import subprocess
+import numpy as np
+## Benchmark helpers
+## What benchmark_training.py, benchmark_accumulation.py, benchmark_recompute.py and train_parallel.py share: the synthetic cohort, timing and memory callbacks and the one-process-per-run harness ##
+## Each benchmark re-runs its own script as a child python process per setting (precision policy and peak memory are per process), the child prints its result as json on its last line ##
+## tensorflow is only imported inside the functions that need it, so the parent process stays light ##
+# Functions in this script:
+#   synthetic_cohort, peak_rss_mb, gpu_peak_mb, timer, samples_per_s, run_child
+#   result = run_child(__file__, num_subjs, epochs, roi, mode) # in the parent, the child prints json.dumps(result)
+
+def synthetic_cohort(num_subjs, shape, seed=13):
+    ''' smooth random volumes between 0 and 1 with labels 1-4, shaped like a loaded cohort '''
+    from scipy import ndimage
+    rng = np.random.default_rng(seed)
+    images = np.empty((num_subjs,) + tuple(shape), dtype=np.float32)
+    for i in range(num_subjs):
+        images[i] = ndimage.gaussian_filter(rng.random(shape, dtype=np.float32), 2)
+    images -= images.min()
+    images /= images.max()
+    return images, list(rng.integers(1, 5, num_subjs))
+
+def peak_rss_mb():
+    ''' highest resident memory of this process so far '''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10 # bytes on mac, kB on linux
+    except ImportError: # windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+def gpu_peak_mb():
+    ''' the first gpu's peak memory, None without a gpu '''
+    import tensorflow as tf
+    return tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2 ** 20 if tf.config.list_physical_devices('GPU') else None
+
+def timer(per='epoch'):
+    ''' a keras callback that appends how long each epoch (per='epoch') or training step (per='batch') took to its .times '''
+    from tensorflow import keras
+    def begin(self, *args, **kwargs):
+        self.start = time.perf_counter()
+
+    def end(self, *args, **kwargs):
+        self.times.append(time.perf_counter() - self.start)
+
+    hooks = ('on_epoch_begin', 'on_epoch_end') if per == 'epoch' else ('on_train_batch_begin', 'on_train_batch_end')
+    callback = type('Timer', (keras.callbacks.Callback,), dict(zip(hooks, (begin, end))))()
+    callback.times = []
+    return callback
+
+def samples_per_s(times, samples):
+    ''' samples per second over the epochs in times, each of samples, leaving out the first (tracing) unless it's the only one '''
+    timed = times[1:] or times
+    return samples * len(timed) / sum(timed)
+
+def run_child(script, *args):
+    ''' runs script (python script, args) in a fresh python process and returns the json on the last line it printed '''
+    out = subprocess.run([sys.executable, os.path.abspath(script)] + [str(a) for a in args], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
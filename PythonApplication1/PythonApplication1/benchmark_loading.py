@@ -0,0 +1,73 @@
+import sys
+import os
+import json
+import time
+import subprocess
+import numpy as np
+import pandas as pd
+import nibabel as nib #reading MR images
+from mri_loader import load_cohort
+## Benchmark of the two nifti read paths in mri_loader, full get_fdata volumes vs slab-only proxy reads ##
+## Each mode runs in a fresh python process (workers=1) so peak RSS and io counters only belong to that mode ##
+## Note .nii.gz still has to be decompressed up to the last slab byte, the saving there is in allocation and scaling, plain .nii also skips the reads ##
+# run: python benchmark_loading.py Z:/PRONIA_data/Tables/pronia_full_niftis.csv 100 [wp1]
+
+modes = ['full', 'proxy']
+slab = (101, 117)
+crop = ((20, 60), (50, 90))
+
+def read_bytes():
+    ''' bytes this process has read through read() calls so far, None if the platform can't say '''
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return getattr(counters, 'read_chars', counters.read_bytes) # read_chars (linux) includes page cache hits
+    except (ImportError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['rchar'])
+    except OSError:
+        return None
+
+def peak_rss():
+    ''' peak resident memory of this process in MB '''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if sys.platform != 'darwin' else peak / 1024**2 # kB on linux, bytes on mac
+    except ImportError:
+        import psutil # windows
+        return psutil.Process().memory_info().peak_wset / 1024**2
+
+def run_mode(csv_path, num_subjs, mri_type, mode):
+    ''' loads the cohort once with one read path and returns the measurements '''
+    filepath_df = pd.read_csv(csv_path)
+    paths = filepath_df[mri_type][:num_subjs]
+    # voxels the read path has to materialise, float64 full volumes for get_fdata vs the cropped float32 slab
+    if mode == 'full':
+        decoded = sum(np.prod(nib.load(p).shape) * 8 for p in paths)
+    else:
+        depth, h, w = slab[1] - slab[0], crop[0][1] - crop[0][0], crop[1][1] - crop[1][0]
+        decoded = len(paths) * depth * h * w * 4
+    rss_before = peak_rss()
+    io_before = read_bytes()
+    start = time.perf_counter()
+    images, labels = load_cohort(filepath_df, num_subjs, mri_type=mri_type, slab=slab, crop=crop, workers=1, proxy=(mode == 'proxy'))
+    seconds = time.perf_counter() - start
+    io_after = read_bytes()
+    return {'mode': mode, 'seconds': seconds, 'decoded_MB': decoded / 1024**2,
+            'read_MB': None if io_before is None else (io_after - io_before) / 1024**2,
+            'peak_rss_MB': peak_rss(), 'rss_before_MB': rss_before, 'output_MB': images.nbytes / 1024**2}
+
+if __name__ == '__main__':
+    csv_path, num_subjs = sys.argv[1], int(sys.argv[2])
+    mri_type = sys.argv[3] if len(sys.argv) > 3 else 'wp1'
+    if len(sys.argv) > 4: # child process, one mode
+        print(json.dumps(run_mode(csv_path, num_subjs, mri_type, sys.argv[4])))
+    else:
+        results = []
+        for mode in modes:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), csv_path, str(num_subjs), mri_type, mode], capture_output=True, text=True, check=True)
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        print(pd.DataFrame(results).set_index('mode').round(2).to_string())
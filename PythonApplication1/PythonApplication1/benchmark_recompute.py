@@ -0,0 +1,40 @@
+import sys
+import json
+import pandas as pd
+from benchmark_common import synthetic_cohort, peak_rss_mb, gpu_peak_mb, timer, run_child
+## Benchmark of activation recomputation (build_cvae(recompute=True)), memory saved against the extra compute time ##
+## Trains the MRI_CVAE model on synthetic cohorts (benchmark_common) of each roi's shape, up to the full 144*128*128 volume, with and without recompute ##
+## Each run is a fresh python process so its peak memory is its own, training_rss_mb is how far fit pushed the peak past where it was before training ##
+# run: python benchmark_recompute.py [steps=4]
+
+configs = [('mri_cvae', 8), ('wholebrain', 8), ('full', 1)] # (roi, batch_size), each with recompute off and on
+
+def run_config(roi, batch_size, recompute, steps):
+    ''' trains steps + 1 batches (the first one traces) and returns the measurements '''
+    import numpy as np
+    from tensorflow import keras
+    from mri_roi import roi_shape
+    from mri_cvae_model import build_cvae
+    from mri_pipeline import cohort_dataset
+    keras.utils.set_random_seed(13)
+    shape = roi_shape(roi)
+    images, labels = synthetic_cohort(batch_size * (steps + 1), shape)
+    models = build_cvae(*shape, inchannel=1, n_y=5, recompute=recompute, summary=False)
+    train_ds = cohort_dataset(images, labels, batch_size, num_classes=5, shuffle=False, indices=np.arange(len(images))).cache()
+    before = peak_rss_mb()
+    step_timer = timer('batch')
+    models['cvae'].fit(train_ds, epochs=1, verbose=0, callbacks=[step_timer])
+    return {'roi': roi, 'shape': 'x'.join(map(str, shape)), 'batch_size': batch_size, 'recompute': recompute, 's_per_step': float(np.median(step_timer.times[1:])),
+            'peak_rss_mb': peak_rss_mb(), 'training_rss_mb': peak_rss_mb() - before, 'gpu_peak_mb': gpu_peak_mb()}
+
+if __name__ == '__main__':
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    if len(sys.argv) > 2: # child process, one config
+        print(json.dumps(run_config(sys.argv[2], int(sys.argv[3]), sys.argv[4] == 'True', steps)))
+    else:
+        results = pd.DataFrame([run_child(__file__, steps, roi, batch_size, recompute) for roi, batch_size in configs for recompute in (False, True)])
+        results = results.set_index(['roi', 'recompute'])
+        plain = results.xs(False, level='recompute')
+        results['memory_saved'] = 1 - results['training_rss_mb'] / plain['training_rss_mb'].reindex(results.index.get_level_values('roi')).values
+        results['extra_time'] = results['s_per_step'] / plain['s_per_step'].reindex(results.index.get_level_values('roi')).values - 1
+        print(results.round(3).to_string())
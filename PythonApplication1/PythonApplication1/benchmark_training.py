@@ -0,0 +1,45 @@
+import sys
+import json
+import numpy as np
+import pandas as pd
+from benchmark_common import synthetic_cohort, timer, samples_per_s, run_child
+## Benchmark of the CVAE training modes in mri_cvae_model.training_mode, float32 vs XLA and bfloat16 mixed precision ##
+## Trains the MRI_CVAE model on a synthetic cohort (smoothed noise blobs, min-max normalised, random labels) so it runs anywhere ##
+## Each mode runs in a fresh python process (the precision policy is global), same data and seed, samples/sec leaves out the first (compiling) epoch ##
+## final val_loss should match float32 closely, if it doesn't the faster mode is changing results ##
+# run: python benchmark_training.py [num_subjs=128] [epochs=4] [roi=mri_cvae]
+
+modes = ['float32', 'xla', 'bf16', 'xla_bf16']
+batch_size = 8
+
+def run_mode(num_subjs, epochs, roi, mode):
+    ''' trains for epochs in one mode and returns the measurements '''
+    from tensorflow import keras
+    from mri_roi import roi_shape
+    from mri_cvae_model import build_cvae, training_mode
+    from mri_pipeline import cohort_dataset
+    keras.utils.set_random_seed(13)
+    shape = roi_shape(roi) # None box axes (the whole volume) and padding included
+    images, labels = synthetic_cohort(num_subjs, shape)
+    train_idx, test_idx = np.arange(num_subjs)[:int(num_subjs * 0.8)], np.arange(num_subjs)[int(num_subjs * 0.8):]
+    kwargs = training_mode(mode)
+    models = build_cvae(*shape, inchannel=1, n_y=5, summary=False, **kwargs)
+    train_ds = cohort_dataset(images, labels, batch_size, num_classes=5, shuffle=True, indices=train_idx).cache() # cached so input isn't measured
+    val_ds = cohort_dataset(images, labels, batch_size, num_classes=5, shuffle=False, indices=test_idx).cache()
+    epoch_timer = timer('epoch')
+    history = models['cvae'].fit(train_ds, epochs=epochs, validation_data=val_ds, verbose=0, callbacks=[epoch_timer])
+    return {'mode': mode, 'policy': keras.mixed_precision.global_policy().name, 'jit_compile': kwargs['jit_compile'],
+            'first_epoch_s': epoch_timer.times[0], 'samples_per_s': samples_per_s(epoch_timer.times, len(train_idx)),
+            'final_loss': history.history['loss'][-1], 'final_val_loss': history.history['val_loss'][-1]}
+
+if __name__ == '__main__':
+    num_subjs = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    epochs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    roi = sys.argv[3] if len(sys.argv) > 3 else 'mri_cvae'
+    if len(sys.argv) > 4: # child process, one mode
+        print(json.dumps(run_mode(num_subjs, epochs, roi, sys.argv[4])))
+    else:
+        results = pd.DataFrame([run_child(__file__, num_subjs, epochs, roi, mode) for mode in modes]).set_index('mode')
+        results['speedup'] = results['samples_per_s'] / results.loc['float32', 'samples_per_s']
+        results['val_loss_change'] = results['final_val_loss'] / results.loc['float32', 'final_val_loss'] - 1
+        print(results.round(3).to_string())
@@ -1,4 +1,3 @@
-import MRI_CVAE
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -18,8 +17,9 @@ def get_namedlayer(layer_name, cvae, x_train, y_train, model = 'encoder'):
     ''' gets one named layer of model
     get_namedlayer('encoded', cvae, x_train, y_train) '''
     layer = layer_name
-    intermediate_layer_model = keras.Model(inputs=[cvae.inputs], outputs=[cvae.get_layer(model).get_layer(layer).get_output_at(0)])
-    intermediate_output = intermediate_layer_model.predict([x_train, y_train]) # intermediate output is label, 1503 dense, reshape to 
+    submodel = cvae.get_layer(model) # the cvae is subclassed, so the submodel's own inputs are used
+    intermediate_layer_model = keras.Model(inputs=submodel.inputs, outputs=[submodel.get_layer(layer).output])
+    intermediate_output = intermediate_layer_model.predict([np.asarray(x_train), y_train]) # intermediate output is label, 1503 dense, reshape to 
     return intermediate_output
 
 def lat_dimension(z):
@@ -30,6 +30,15 @@ def lat_dimension(z):
         list.append(tup)
     return(list)
 
+def split_data(images, labels, split_path):
+    ''' x_train, x_test, y_train, y_test, train_label, test_label from the split saved by the training script, so analysis uses the same partition
+    split_data(images, labels, 'C:/Users/Mischa/sophie/models/MRI_CVAE/split.npz') '''
+    from mri_split import load_split, CohortView
+    from keras.utils import to_categorical
+    train_idx, test_idx, _, _ = load_split(split_path)
+    train_label, test_label = [labels[i] for i in train_idx], [labels[i] for i in test_idx]
+    return CohortView(images, train_idx), CohortView(images, test_idx), to_categorical(train_label), to_categorical(test_label), train_label, test_label
+
 ## Looking at variation between predictions and x_test sets (predictions are all very similar, 99%)
 
 def structural_sim_data(data):
@@ -53,7 +62,7 @@ def structural_sim_data(data):
 def var_boxplot(x_test, y_test, cvae):
     var_boxplot.x_test_results = structural_sim_data(x_test)
 
-    prediction = cvae.predict([x_test, y_test])
+    prediction = cvae.predict([np.asarray(x_test), y_test])
     prediction = prediction[:,:,:,:,0]
     var_boxplot.prediction_results = structural_sim_data(prediction)
     import seaborn as sns
@@ -84,7 +93,7 @@ def lda(encoder, x_train, y_train, train_label):
     ''' total LDA analysis, outputs plots and can return a variable too if needed
     lda(encoder, x_train, y_train, train_label) '''
     from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-    z_mean_pred, z_sig, z_label_pred, z_pred = encoder.predict([x_train, y_train], batch_size=16)
+    z_mean_pred, z_sig, z_label_pred, z_pred = encoder.predict([np.asarray(x_train), y_train], batch_size=16)
     sklearn_lda = LinearDiscriminantAnalysis()
     y = np.array(train_label)
     z_pred = pd.DataFrame(z_pred)
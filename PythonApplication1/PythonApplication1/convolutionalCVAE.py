@@ -20,15 +20,14 @@ if gpus:
 from keras.utils import to_categorical
 
 import matplotlib.pyplot as plt
-(x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
+from mnist_data import load_mnist, mnist_dataset, scale_batch
+(x_train, y_train), (x_test, y_test) = load_mnist() # uint8 memmaps, 60000 28 28
 # reshaping the data (google why this way)
 print(x_train.shape)
 #x_train = np.reshape(x_train, (len(x_train), 28, 28, 1))
 #x_test = np.reshape(x_test, (len(x_test), 28, 28, 1))
-# then changing the data type and making pixel values between 1 and 0
-x_train = x_train.reshape((len(x_train), np.prod(x_train.shape[1:]))) 
-x_train = x_train.astype('float32') / 255
-x_test = x_test.astype('float32') / 255
+# then changing the data type and making pixel values between 1 and 0, x_train a batch at a time as it's trained on (mnist_dataset)
+x_test = scale_batch(x_test) # 10000, 28, 28, small enough to scale once for the plots
 print(x_train.shape, x_test.shape)         
 plot_labels_test = y_test
 plot_labels_train = y_train
@@ -110,7 +109,8 @@ cvae.add_loss(vae_loss)
 cvae.compile(optimizer=keras.optimizers.Adam())
 
         
-history = cvae.fit(x_train, x_train, batch_size= batch_size, epochs=epochs, verbose = 2)
+train_ds = mnist_dataset(x_train, batch_size=batch_size, shape=(784,)) # (x, x) batches of flattened float32 digits
+history = cvae.fit(train_ds, epochs=epochs, verbose = 2)
 # .fit function returns history object with loss metrics
 print(history.history.keys())
 
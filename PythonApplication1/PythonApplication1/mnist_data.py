@@ -0,0 +1,93 @@
+import os
+import gzip
+import shutil
+import struct
+import numpy as np
+## MNIST
+## One IDX reader for every MNIST script instead of keras.datasets.mnist.load_data() (needs the network) or extract_data/extract_labels (re-inflates the .gz every run) ##
+## A .gz is decompressed once into cache_dir, after that the raw IDX file is memory mapped and the arrays are zero-copy uint8 views of it ##
+## The header (magic, type code, dims) is checked against the file size before mapping, so a truncated download fails loudly ##
+## Pixels stay uint8 until a batch is asked for, mnist_dataset scales each batch to float32 [0, 1] as it's gathered ##
+# Functions in this script:
+#   read_idx, load_mnist, scale_batch, mnist_dataset
+#   (x_train, y_train), (x_test, y_test) = load_mnist()
+
+mnist_dir = 'C:/Users/Mischa/Documents/Uni Masters/Diss project/Practise'
+mnist_files = {'x_train': 'train-images-idx3-ubyte', 'y_train': 'train-labels-idx1-ubyte',
+               'x_test': 't10k-images-idx3-ubyte', 'y_test': 't10k-labels-idx1-ubyte'}
+idx_types = {0x08: np.uint8, 0x09: np.int8, 0x0B: np.dtype('>i2'), 0x0C: np.dtype('>i4'), 0x0D: np.dtype('>f4'), 0x0E: np.dtype('>f8')}
+
+def _decompress(gz_path, cache_dir):
+    ''' path of the uncompressed copy of gz_path in cache_dir, only inflated again if the .gz is newer than the copy '''
+    os.makedirs(cache_dir, exist_ok=True)
+    raw_path = os.path.join(cache_dir, os.path.basename(gz_path)[:-3])
+    if os.path.exists(raw_path) and os.path.getmtime(raw_path) >= os.path.getmtime(gz_path):
+        return raw_path
+    tmp = raw_path + '.tmp'
+    with gzip.open(gz_path, 'rb') as src, open(tmp, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 2**20)
+    os.replace(tmp, raw_path) # a half written copy never gets mapped
+    return raw_path
+
+def read_idx(path, cache_dir=None):
+    ''' read-only memmap of an IDX file shaped by its header (e.g. images N, 28, 28 uint8, labels N uint8)
+        a .gz path is decompressed into cache_dir first (default an idx_cache folder next to it), later calls map the cached copy '''
+    if path.endswith('.gz'):
+        path = _decompress(path, cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), 'idx_cache'))
+    with open(path, 'rb') as f:
+        zero, code, ndim = struct.unpack('>HBB', f.read(4))
+        if zero != 0 or code not in idx_types or ndim == 0:
+            raise ValueError('%s is not an IDX file (magic %04x %02x %d)' % (path, zero, code, ndim))
+        dims = struct.unpack('>%dI' % ndim, f.read(4 * ndim))
+    dtype = np.dtype(idx_types[code])
+    offset = 4 + 4 * ndim
+    expected = offset + int(np.prod(dims)) * dtype.itemsize
+    if os.path.getsize(path) != expected:
+        raise ValueError('%s is %d bytes, its header %s says %d' % (path, os.path.getsize(path), dims, expected))
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=dims)
+
+def load_mnist(data_dir=mnist_dir, cache_dir=None):
+    ''' (x_train, y_train), (x_test, y_test) like keras.datasets.mnist.load_data(), but as uint8 memmaps read from data_dir
+        each file can be there as the raw IDX or the .gz, the raw one is used if both are '''
+    arrays = {}
+    for name, filename in mnist_files.items():
+        path = os.path.join(data_dir, filename)
+        if not os.path.exists(path):
+            path += '.gz'
+        arrays[name] = read_idx(path, cache_dir)
+    if len(arrays['x_train']) != len(arrays['y_train']) or len(arrays['x_test']) != len(arrays['y_test']):
+        raise ValueError('image and label files in %s have different lengths' % data_dir)
+    return (arrays['x_train'], arrays['y_train']), (arrays['x_test'], arrays['y_test'])
+
+def scale_batch(x, shape=None):
+    ''' uint8 pixels to float32 in [0, 1], reshaped per sample to shape (e.g. (784,) or (28, 28, 1)) '''
+    x = np.asarray(x, dtype=np.float32) / 255
+    return x if shape is None else x.reshape((len(x),) + tuple(shape))
+
+def mnist_dataset(images, labels=None, batch_size=128, shape=(784,), num_classes=10, shuffle=True, seed=13, indices=None):
+    ''' tf.data batches out of the uint8 arrays, only the indices are shuffled and each batch is gathered and scaled in a parallel map
+        gives (x, x) for the VAEs, or ([x, onehot], x) for the CVAEs if labels are given, indices restricts it to those rows (e.g. a validation split)
+        vae.fit(mnist_dataset(x_train), validation_data=mnist_dataset(x_test, shuffle=False)) '''
+    import tensorflow as tf
+    shape = tuple(shape)
+    onehot = None if labels is None else np.eye(num_classes, dtype=np.float32)[np.asarray(labels, dtype=np.int64)]
+
+    def gather(idx):
+        idx = np.sort(idx) # sequential reads from the memmap, order inside a batch doesn't matter
+        x = scale_batch(images[idx], shape)
+        return (x, onehot[idx]) if onehot is not None else (x,)
+
+    def gather_batch(idx):
+        out = tf.numpy_function(gather, [idx], [tf.float32, tf.float32] if onehot is not None else [tf.float32])
+        out[0].set_shape((None,) + shape)
+        if onehot is None:
+            return out[0], out[0]
+        out[1].set_shape((None, num_classes))
+        return (out[0], out[1]), out[0]
+
+    indices = np.arange(len(images)) if indices is None else np.asarray(indices)
+    ds = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        ds = ds.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size).map(gather_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.prefetch(tf.data.experimental.AUTOTUNE)
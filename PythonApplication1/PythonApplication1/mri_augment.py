@@ -0,0 +1,128 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+import tensorflow as tf
+from mri_pipeline import epoch_seeds
+## Augmentation
+## Random flips, small affine jitter (rotation, scale, shift), elastic deformation and intensity scaling for the 3D training volumes, done on the CPU while the model trains ##
+## augment_dataset slots in between a dataset from mri_pipeline / mri_tfrecord and cvae.fit, batches are augmented in a parallel map and prefetched ##
+## Every batch carries its own seed from a seeded random dataset, so a run is repeatable however the threads are scheduled, and each epoch still gets new draws ##
+## Flips, affine and elastic displacement are composed into one interpolation per volume (all channels share the same transform) ##
+# Functions in this script:
+#   Augmenter, augment_dataset, augment_rate
+#   train_ds = augment_dataset(cohort_dataset(images, labels, 8, n_y, indices=train_idx), Augmenter(clip=(0., 1.)))
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+def _rotation(angles):
+    ''' 3*3 rotation about the depth, H and W axes in turn, angles in radians '''
+    matrix = np.eye(3)
+    for axis, angle in enumerate(angles):
+        a, b = [i for i in range(3) if i != axis]
+        r = np.eye(3)
+        r[a, a], r[a, b], r[b, a], r[b, b] = np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)
+        matrix = matrix @ r
+    return matrix
+
+def _augment_one(augmenter, volume, seed):
+    return augmenter.augment(volume, np.random.default_rng(seed))
+
+class Augmenter:
+    ''' random augmentation of depth, H, W[, C] volumes
+        flip_axes are flipped with probability 0.5 each, axis 1 (H) is left-right for the PRONIA niftis (nifti axis 0)
+        rotate (degrees), scale (fraction) and shift (voxels) are the largest affine jitter, per axis or one value for all three
+        elastic is the largest elastic displacement in voxels (0 turns it off), elastic_sigma how smooth the field is
+        intensity scales each channel by 1 +- intensity, clip=(0., 1.) keeps min-max normalised volumes in range
+        workers > 1 augments the volumes of a batch in a pool (executor 'thread' or 'process') '''
+    def __init__(self, flip_axes=(1,), rotate=5., scale=0.05, shift=2., elastic=2., elastic_sigma=4., intensity=0.1, clip=None, order=1, workers=1, executor='thread'):
+        self.flip_axes = tuple(flip_axes)
+        self.rotate = np.broadcast_to(np.deg2rad(rotate), 3)
+        self.scale = np.broadcast_to(scale, 3)
+        self.shift = np.broadcast_to(shift, 3)
+        self.elastic = elastic
+        self.elastic_sigma = elastic_sigma
+        self.intensity = intensity
+        self.clip = clip
+        self.order = order
+        self.workers = workers
+        self.executor = executor
+        self._pool = None
+
+    def __getstate__(self): # process workers get the settings, not the pool
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def augment(self, volume, rng):
+        ''' one augmented copy of volume (depth, H, W[, C]) as float32, every draw comes from rng '''
+        volume = np.asarray(volume, dtype=np.float32)
+        channels = volume[..., None] if volume.ndim == 3 else volume
+        shape = channels.shape[:3]
+        centre = (np.array(shape) - 1) / 2.
+        # output voxel -> input voxel: input = matrix @ (out - centre) + centre + offset (+ elastic displacement)
+        matrix = _rotation(rng.uniform(-1, 1, 3) * self.rotate) @ np.diag(1. / (1. + rng.uniform(-1, 1, 3) * self.scale))
+        for axis in self.flip_axes:
+            if rng.random() < 0.5:
+                matrix[:, axis] = -matrix[:, axis]
+        offset = centre - matrix @ centre + rng.uniform(-1, 1, 3) * self.shift
+        out = np.empty(channels.shape, dtype=np.float32)
+        if self.elastic:
+            grid = np.indices(shape, dtype=np.float32).reshape(3, -1)
+            coords = (matrix @ grid + offset[:, None]).reshape((3,) + shape)
+            for axis in range(3):
+                field = ndimage.gaussian_filter(rng.uniform(-1, 1, shape), self.elastic_sigma)
+                coords[axis] += field * (self.elastic / max(np.abs(field).max(), 1e-6))
+            for c in range(channels.shape[-1]):
+                ndimage.map_coordinates(channels[..., c], coords, output=out[..., c], order=self.order, mode='constant', cval=0.)
+        else:
+            for c in range(channels.shape[-1]):
+                ndimage.affine_transform(channels[..., c], matrix, offset, output=out[..., c], order=self.order, mode='constant', cval=0.)
+        out *= (1. + rng.uniform(-1, 1, channels.shape[-1]) * self.intensity).astype(np.float32)
+        if self.clip is not None:
+            np.clip(out, self.clip[0], self.clip[1], out=out)
+        return out.reshape(volume.shape)
+
+    def augment_batch(self, x, seed):
+        ''' augments every volume in x (batch, depth, H, W[, C]), each gets its own generator spawned from seed '''
+        seeds = np.random.SeedSequence([int(s) & 0xFFFFFFFFFFFFFFFF for s in np.ravel(seed)]).spawn(len(x)) # an int or a stateless seed pair
+        if self.workers <= 1:
+            return np.stack([_augment_one(self, v, s) for v, s in zip(x, seeds)]) if len(x) else np.asarray(x, dtype=np.float32)
+        if self._pool is None:
+            self._pool = (ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor)(max_workers=self.workers)
+        return np.stack(list(self._pool.map(_augment_one, [self] * len(x), list(x), seeds)))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+def augment_dataset(ds, augmenter, seed=13):
+    ''' augments the images of a ((x, y), x) dataset (cohort_dataset, nifti_dataset, tfrecord_dataset), input and target get the same augmented image
+        a ((x, y), x, mask) dataset has its mask moved with the image (augmented as an extra channel, then thresholded at 0.5)
+        seed fixes the whole sequence of draws, for training sets only '''
+    seeds = epoch_seeds(seed) # one seed per batch, new ones every epoch
+
+    def augment(element, batch_seed):
+        (x, y), _ = element[:2]
+        if len(element) > 2: # same flips, affine and elastic field for the mask
+            both = tf.numpy_function(augmenter.augment_batch, [tf.concat([x, tf.cast(element[2], x.dtype)], -1), batch_seed], tf.float32)
+            xa, mask = both[..., :-1], both[..., -1:] > 0.5
+            xa.set_shape(x.shape)
+            mask.set_shape(element[2].shape)
+            return (xa, y), xa, mask
+        xa = tf.numpy_function(augmenter.augment_batch, [x, batch_seed], tf.float32)
+        xa.set_shape(x.shape)
+        return (xa, y), xa
+
+    ds = tf.data.Dataset.zip((ds, seeds)).map(augment, num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+def augment_rate(augmenter, volumes, batch_size=8, batches=20, seed=13):
+    ''' batches per second one augmentation call manages on volumes (e.g. x_train), compare it with the model's steps per second
+        the dataset runs several of these at once, so if this alone is faster than training the augmentation adds no time '''
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    for b in range(batches):
+        augmenter.augment_batch(np.asarray(volumes[np.sort(rng.choice(len(volumes), batch_size))]), b)
+    return batches / (time.perf_counter() - start)
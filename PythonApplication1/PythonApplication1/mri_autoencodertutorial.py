@@ -71,44 +71,31 @@ mri_types =['wp0', # whole brain
 #niis = get_niis(10)
 
 
-niis = []
+workers = 8 # threads reading niftis in parallel
 
-for i in range(num_subjs):
-    row = filepath_df.iloc[i]
-    nii_path = row['wp0']
-    nii = nib.load(nii_path)
-    nii = nii.get_fdata()
-    nii = nii[:, 78:90, :]
-    for j in range(nii.shape[1]):
-        niis.append((nii[:,j,:]))
-
-#print(nii.shape) # 121, 51, 121
-
-nii[:,0,:].shape
+from mri_loader import load_cohort
+# Pad images with zeros at boundaries so the dimenson is even and easier to downsample images by two while passing through model. Three rows and columns make dim 124*124
+images, _ = load_cohort(filepath_df, num_subjs, mri_type='wp0', slab=(78, 90), crop=None, pad=((3, 0), (3, 0)), workers=workers)
+#print(images.shape) # 200, 12, 124, 124
 
 # Preprocessing
 
-images = np.asarray(niis)
-# shape 530*121*121
 #print(images.shape) # 510, 121, 121
 
 # reshape to matrix in able to feed into network
-images = images.reshape(-1, 121, 121, 1)
-#print(images.shape) # 510,121,121,1
+images = images.reshape(-1, 124, 124, 1) # a view, no copy
+#print(images.shape) # 2400,124,124,1
 plt.imshow(images[1])
 plt.show()
-# min-max normalisation to rescale (why?)
-m = np.max(images)
-mi = np.min(images)
+# min-max normalisation to rescale (why?), in place on the unpadded part
+brain = images[:, 3:, 3:, :]
+m = np.max(brain)
+mi = np.min(brain)
 print(m ,mi) # 2.99, 0 
-images = (images - mi) / (m - mi)
+brain -= mi
+brain /= (m - mi)
 #print(np.min(images), np.max(images)) # 0, 1
 
-# Pad images iwth zeros at boundaries so the dimenson is even and easier to downsample images by two while passing through model. Add in three rows and columns to make dim 176*176
-temp = np.zeros([2400,124,124,1])
-temp[:,3:,3:,:] = images
-images = temp # dim now 510 *124*124*1
-
 # test train split (no labels for standard autoencoder)
 train_X,valid_X,train_ground,valid_ground = train_test_split(images, images, test_size=0.2, random_state=13)
 
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from mri_loader import load_cohort, cohort_shape
+from mri_stats import array_stats, normalise as normalise_images, subject_zscore
+from mri_quantise import QuantisedCohort, save_quantised, load_quantised
+from mri_sparse import save_blocks, load_blocks
+from mri_resample import voxel_size, save_resampled, load_resampled
+## Cache
+## On-disk cache of the preprocessed cohort (loaded, cropped and normalised images + labels) so scripts don't re-read every nifti each run ##
+## Each entry is a folder named by a hash of everything that went into it, images.npy / labels.npy and a manifest.json ##
+## Changing the csv rows, a nifti on disk, mri_type, slab, crop, dtype or normalisation gives a new key, other entries are left alone ##
+## The normalisation stats used are kept in the manifest (return_stats=True), pass them back in as stats to normalise new subjects the same way ##
+## A list of mri types caches the channel-stacked cohort, each channel is normalised with its own stats (stats is then a list, one per channel) ##
+## quantise='uint8' / 'float16' also keeps a quantised copy in the entry (mri_quantise) and returns that instead, a quarter / half the memory of float32 ##
+## cached_mask gives each subject's brain mask (rp1/rp2 above a threshold) over the same roi, as bool, for the mask-aware reconstruction loss ##
+## sparse=(8, 8, 8) keeps a block-sparse copy (mri_sparse, only blocks with brain in them) and returns that, of the quantised codes if quantise is set too ##
+## resample=3. keeps the cohort resampled to 3mm voxels (mri_resample, anti-aliased) in the entry and returns that, quantise / sparse then apply to the resampled images ##
+# Functions in this script:
+#   cohort_key, cached_cohort, cached_mask, open_cached, clear_cache
+
+def cohort_key(filepath_df, num_subjs, mri_type='wp1', slab=(101, 117), crop=((20, 60), (50, 90)), dtype=np.float32, normalise='minmax', label_col='STUDYGROUP', stats=None, mask_type=None, pad=None, percentiles=(1, 99)):
+    ''' returns the cache key (hex digest) and the config dict it was made from, percentiles only count for normalise='robust' '''
+    rows = filepath_df.iloc[:num_subjs]
+    files = []
+    for t in (mri_type if isinstance(mri_type, (list, tuple)) else [mri_type]):
+        for path, label in zip(rows[t], rows[label_col]):
+            stat = os.stat(path) # a re-run preprocessing changes size or mtime
+            files.append([str(path), int(label), stat.st_size, stat.st_mtime_ns])
+    config = {'mri_type': mri_type if isinstance(mri_type, str) else list(mri_type), 'slab': list(slab), 'crop': None if crop is None else [list(c) for c in crop],
+              'dtype': np.dtype(dtype).name, 'normalise': normalise, 'label_col': label_col, 'num_subjs': len(rows),
+              'stats': stats, 'mask_type': mask_type}
+    if pad is not None: # only in the key when it's used, so unpadded entries keep their keys
+        config['pad'] = [list(p) for p in pad]
+    if normalise == 'robust': # the range robust scales to
+        config['percentiles'] = [float(p) for p in percentiles]
+    digest = hashlib.sha1(json.dumps([config, files], sort_keys=True).encode()).hexdigest()
+    return digest[:16], config
+
+def cached_cohort(filepath_df, num_subjs, cache_dir, mri_type='wp1', slab=(101, 117), crop=((20, 60), (50, 90)), dtype=np.float32, normalise='minmax', label_col='STUDYGROUP', workers=None, mmap=True,
+                  stats=None, mask_type=None, percentiles=(1, 99), return_stats=False, quantise=None, sparse=None, pad=None, resample=None):
+    ''' returns normalised images (num_subjs, depth, H, W) and labels, from the cache if there's an entry for this config, otherwise loads (load_cohort with proxy reads) and stores it
+        mmap=True opens cached images read-only memory-mapped, so a hit costs milliseconds and pages are read as they're used
+        normalise is 'minmax', 'zscore', 'robust' (percentiles range to 0-1), 'subject_zscore' (each subject within its mask_type mask) or None, see mri_stats
+        stats are worked out one subject at a time over the loaded cohort, or pass saved training stats (load_stats) to normalise new subjects with them
+        return_stats=True also returns the stats dict, ready for save_stats
+        quantise='uint8' or 'float16' returns a QuantisedCohort (float32 when indexed) made once from the cached images, its max_error says how far off it is
+        sparse=(8, 8, 8) returns a BlockCohort (dense when indexed) that only stores the blocks with non-zero voxels, smaller on disk and quicker to read
+        pad zero-pads every slice like load_cohort (roi_args gives it for the padded rois)
+        resample=3. (mm) returns the cohort resampled to that voxel size (the niftis' own size is read from a header), made once in a thread pool next to the full resolution images
+        cached_cohort(filepath_df, 698, 'C:/cohort_cache', 'wp1', (101, 117), ((20, 60), (50, 90))) '''
+    if normalise == 'subject_zscore' and mask_type is None:
+        raise ValueError('subject_zscore needs mask_type (e.g. rp1), the mask each subject is standardised within')
+    key, config = cohort_key(filepath_df, num_subjs, mri_type, slab, crop, dtype, normalise, label_col, stats, mask_type, pad, percentiles)
+    entry = os.path.join(cache_dir, key)
+    # manifest is written last, so an entry without one is an interrupted write
+    if os.path.exists(os.path.join(entry, 'manifest.json')):
+        images = np.load(os.path.join(entry, 'images.npy'), mmap_mode='r' if mmap or quantise or sparse or resample else None)
+        images = _stored(entry, _resampled(entry, images, resample, filepath_df, mri_type, workers, mmap), quantise, sparse, mmap, _name(resample))
+        labels = np.load(os.path.join(entry, 'labels.npy')).tolist()
+        if return_stats:
+            with open(os.path.join(entry, 'manifest.json')) as f:
+                return images, labels, json.load(f)['stats']
+        return images, labels
+
+    # write to a temporary folder then rename, so readers never see half an entry
+    tmp = entry + '.tmp' + str(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    # subjects are loaded straight into the memory-mapped .npy and normalised there, so the cohort is never held twice
+    multi = isinstance(mri_type, (list, tuple))
+    rows = filepath_df.iloc[:num_subjs]
+    paths = list(zip(*[rows[t] for t in mri_type])) if multi else list(rows[mri_type])
+    images = np.lib.format.open_memmap(os.path.join(tmp, 'images.npy'), mode='w+', dtype=dtype, shape=cohort_shape(paths, slab, crop, pad))
+    images, labels = load_cohort(filepath_df, num_subjs, mri_type=mri_type, slab=slab, crop=crop, label_col=label_col, workers=workers, proxy=True, dtype=dtype, pad=pad, out=images)
+    channels = [images[..., c] for c in range(images.shape[-1])] if multi else [images] # views, normalised in place
+    if normalise == 'subject_zscore':
+        masks, _ = load_cohort(filepath_df, num_subjs, mri_type=mask_type, slab=slab, crop=crop, label_col=label_col, workers=workers, proxy=True, dtype=dtype, pad=pad)
+        stats = [array_stats(channel, masks, mask_threshold=0.5) for channel in channels] # raw in-mask stats, kept for reference
+        for channel in channels:
+            subject_zscore(channel, masks)
+        del masks
+    elif normalise is not None:
+        if stats is None:
+            stats = [array_stats(channel, percentiles=percentiles if normalise == 'robust' else ()) for channel in channels]
+        elif not multi:
+            stats = [stats]
+        for channel, channel_stats in zip(channels, stats):
+            normalise_images(channel, channel_stats, normalise, percentiles)
+    if stats is not None and not multi:
+        stats = stats[0]
+    del channels
+    shape = images.shape
+    images.flush()
+    del images # close the memmap before the folder is renamed
+    np.save(os.path.join(tmp, 'labels.npy'), np.asarray(labels))
+    manifest = dict(config, key=key, shape=list(shape), stats=stats, created=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    try:
+        os.replace(tmp, entry)
+    except OSError: # another run wrote the same entry first (or a stale partial one is there)
+        if os.path.exists(os.path.join(entry, 'manifest.json')):
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+    images = np.load(os.path.join(entry, 'images.npy'), mmap_mode='r' if mmap or quantise or sparse or resample else None)
+    images = _stored(entry, _resampled(entry, images, resample, filepath_df, mri_type, workers, mmap), quantise, sparse, mmap, _name(resample))
+    if return_stats:
+        return images, labels, stats
+    return images, labels
+
+def _name(resample):
+    return 'images' if resample is None else 'images_%gmm' % resample
+
+def _resampled(entry, images, resample, filepath_df, mri_type, workers, mmap):
+    ''' the entry's images at resample mm, resampled from the (memory-mapped) full resolution images the first time they're asked for '''
+    if resample is None:
+        return images
+    coarse = load_resampled(entry, resample, mmap=mmap)
+    if coarse is None:
+        first_type = mri_type if isinstance(mri_type, str) else mri_type[0]
+        save_resampled(entry, images, resample, voxel_size(filepath_df[first_type].iloc[0]), workers=workers)
+        coarse = load_resampled(entry, resample, mmap=mmap)
+        print('resampled cohort to %gmm voxels, %s' % (resample, coarse.shape))
+    return coarse
+
+def _stored(entry, images, quantise, sparse, mmap, name='images'):
+    ''' the entry's quantised and/or block-sparse copy of name, made from the (memory-mapped) float images the first time it's asked for '''
+    if not quantise and not sparse:
+        return images
+    if quantise:
+        cohort = load_quantised(entry, quantise, name, mmap=mmap)
+        if cohort is None:
+            save_quantised(entry, images, quantise, name)
+            cohort = load_quantised(entry, quantise, name, mmap=mmap)
+            print('quantised cohort to %s, max error %.3g (bound %s)' % (quantise, cohort.max_error, np.round(cohort.error_bound, 6)))
+        if not sparse:
+            return cohort
+        images, name = cohort.codes, name + '_' + np.dtype(quantise).name
+    blocks = load_blocks(entry, name, mmap=mmap)
+    if blocks is None or blocks.block != tuple(sparse):
+        save_blocks(entry, images, sparse, name)
+        blocks = load_blocks(entry, name, mmap=mmap)
+        print('stored %.0f%% of the cohort\'s blocks, %.1f%% of the dense size' % (100 * blocks.occupied, 100 * blocks.nbytes / blocks.dense_nbytes))
+    return QuantisedCohort(blocks, cohort.scale, cohort.offset, cohort.max_error) if quantise else blocks
+
+def cached_mask(filepath_df, num_subjs, cache_dir, mask_types=('rp1', 'rp2'), threshold=0.5, slab=(101, 117), crop=((20, 60), (50, 90)), pad=None, label_col='STUDYGROUP', workers=None, mmap=True):
+    ''' bool masks (num_subjs, depth, H, W), a voxel is in if any of mask_types is above threshold there, over the same slab/crop/pad as the images
+        the masks are cached like any cohort (un-normalised, one channel per mask type) and the bool mask is kept next to them as mask_<threshold>.npy
+        masks = cached_mask(filepath_df, 698, cache_dir, **roi_args('mri_cvae')) '''
+    mri_type = list(mask_types)
+    key, _ = cohort_key(filepath_df, num_subjs, mri_type, slab, crop, normalise=None, label_col=label_col, pad=pad)
+    path = os.path.join(cache_dir, key, 'mask_%g.npy' % threshold)
+    if not os.path.exists(path):
+        channels, _ = cached_cohort(filepath_df, num_subjs, cache_dir, mri_type, slab, crop, normalise=None, label_col=label_col, workers=workers, pad=pad)
+        masks = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=bool, shape=channels.shape[:4])
+        for i in range(len(channels)): # a subject at a time
+            masks[i] = (channels[i] > threshold).any(axis=-1)
+        masks.flush()
+        del masks
+        os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+def open_cached(cache_dir, key, mmap=True, quantise=None, sparse=None, resample=None):
+    ''' images and labels of an existing entry by its key (e.g. one saved with a trained model), no nifti or csv is touched
+        resample needs the resampled images to be in the entry already (cached_cohort with the same resample made them) '''
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, 'manifest.json')):
+        raise FileNotFoundError('no cached cohort %s in %s, run cached_cohort with the same config to rebuild it' % (key, cache_dir))
+    images = np.load(os.path.join(entry, 'images.npy'), mmap_mode='r' if mmap or quantise or sparse else None) if resample is None else load_resampled(entry, resample, mmap=mmap)
+    if images is None:
+        raise FileNotFoundError('cached cohort %s has no %gmm images, run cached_cohort with resample=%g to make them' % (key, resample, resample))
+    images = _stored(entry, images, quantise, sparse, mmap, _name(resample))
+    return images, np.load(os.path.join(entry, 'labels.npy')).tolist()
+
+def clear_cache(cache_dir, keep=()):
+    ''' deletes every cache entry apart from the keys in keep '''
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name not in keep:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
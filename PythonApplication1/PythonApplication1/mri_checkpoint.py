@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import hashlib
+import queue
+import threading
+import numpy as np
+from tensorflow import keras
+## Checkpointing
+## Resumable training: model weights, optimizer state, the epoch and the early stopping counters are checkpointed at the end of each epoch ##
+## The training thread only copies the values out (a few MB for the CVAEs), a background thread writes them, so fit never waits on the disk ##
+## Each checkpoint is an .npz written to a temp file and renamed, index.json lists them, retention keeps the last keep_last plus the best by val_loss ##
+## Checkpoints live under model_dir/checkpoints in a folder per training config, a run that finished (all its epochs or early stopped) is marked so and never resumed ##
+# Functions in this script:
+#   checkpoint_dir, clear_checkpoints, TrainingCheckpoint
+#   ckpt = TrainingCheckpoint(checkpoint_dir(model_dir, config), cvae, early_stopping=es_callback); initial_epoch = ckpt.restore()
+#   cvae.fit(..., initial_epoch=initial_epoch, callbacks=[es_callback, ckpt]) # after es_callback, so its counters are restored after it resets them
+
+def checkpoint_dir(model_dir, config):
+    ''' the checkpoint folder for config (the model config, cache key and anything else a checkpoint can't be resumed across), so a changed model never loads another's weights '''
+    key = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return os.path.join(model_dir, 'checkpoints', key)
+
+def clear_checkpoints(model_dir):
+    ''' removes every config's checkpoints from model_dir, after the run is saved or before retraining '''
+    shutil.rmtree(os.path.join(model_dir, 'checkpoints'), ignore_errors=True)
+
+def _optimizer_variables(optimizer):
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables) # a method on the older keras optimizers
+
+class TrainingCheckpoint(keras.callbacks.Callback):
+    ''' checkpoints model, model.optimizer, epoch and early_stopping's wait/best every `every` epochs into ckpt_dir, restore() picks the latest one back up
+        keep_last is how many of the latest to keep, the best by monitor (lower is better) is kept on top of those '''
+    def __init__(self, ckpt_dir, model, early_stopping=None, keep_last=3, monitor='val_loss', every=1):
+        super().__init__()
+        self.ckpt_dir = ckpt_dir
+        self.ckpt_model = model
+        self.early_stopping = early_stopping
+        self.keep_last = keep_last
+        self.monitor = monitor
+        self.every = every
+        self.index_path = os.path.join(ckpt_dir, 'index.json')
+        self.index = {'checkpoints': [], 'best': None, 'finished': False}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.best = self.index['best']['value'] if self.index['best'] else None # only the training thread uses this, index belongs to the writer
+        self.es_state = None
+        self.queue = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def restore(self, best=False):
+        ''' loads the latest (or best) checkpoint if there is one and returns the epoch to pass to fit as initial_epoch, 0 if starting fresh
+            a finished run's checkpoints are removed and it starts fresh (resuming it would train at most an epoch more and save over its history), best=True still loads its best '''
+        if self.index.get('finished') and not best:
+            print('the checkpointed run in %s finished, starting fresh' % self.ckpt_dir)
+            shutil.rmtree(self.ckpt_dir, ignore_errors=True)
+            self.index, self.best = {'checkpoints': [], 'best': None, 'finished': False}, None
+        if not self.index['checkpoints']:
+            return 0
+        entry = self.index['best'] if best else self.index['checkpoints'][-1]
+        with np.load(os.path.join(self.ckpt_dir, entry['file'])) as f:
+            self.ckpt_model.set_weights([f['w%d' % i] for i in range(int(f['num_weights']))])
+            optimizer_values = [f['o%d' % i] for i in range(int(f['num_optimizer']))]
+            self.es_state = (int(f['es_wait']), float(f['es_best']))
+        optimizer = self.ckpt_model.optimizer
+        if optimizer_values:
+            if len(_optimizer_variables(optimizer)) < len(optimizer_values): # slots are only made on the first step, make them now
+                if hasattr(optimizer, 'build'):
+                    optimizer.build(self.ckpt_model.trainable_variables)
+                else:
+                    optimizer._create_all_weights(self.ckpt_model.trainable_variables)
+            for variable, value in zip(_optimizer_variables(optimizer), optimizer_values):
+                variable.assign(value)
+        print('resuming from %s (epoch %d)' % (entry['file'], entry['epoch']))
+        return entry['epoch']
+
+    def on_train_begin(self, logs=None):
+        if self.es_state is not None and self.early_stopping is not None:
+            self.early_stopping.wait = self.es_state[0]
+            if not np.isnan(self.es_state[1]): # nan is early stopping's best before it has one
+                self.early_stopping.best = self.es_state[1]
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._raise()
+        current = (logs or {}).get(self.monitor)
+        is_best = current is not None and (self.best is None or current < self.best)
+        if (epoch + 1) % self.every and not is_best:
+            return
+        es = self.early_stopping
+        state = {'weights': self.ckpt_model.get_weights(), # copies, training carries on while these are written
+                 'optimizer': [v.numpy() for v in _optimizer_variables(self.ckpt_model.optimizer)],
+                 'epoch': epoch + 1, 'value': None if current is None else float(current), 'is_best': is_best,
+                 'es_wait': 0 if es is None else es.wait, 'es_best': np.nan if es is None or es.best is None else es.best}
+        if is_best:
+            self.best = float(current)
+        self.queue.put(state)
+
+    def on_train_end(self, logs=None):
+        self.queue.join() # wait for the last writes before the script moves on
+        self._raise()
+        if self.index['checkpoints']: # fit ran to the end or early stopping ended it, an interrupted fit never gets here
+            self.index['finished'] = True
+            self._write_index()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def _write_loop(self):
+        while True:
+            state = self.queue.get()
+            try:
+                self._write(state)
+            except Exception as e: # raised in the training thread at the next epoch end
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state):
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        name = 'ckpt-%05d.npz' % state['epoch']
+        arrays = {'w%d' % i: w for i, w in enumerate(state['weights'])}
+        arrays.update({'o%d' % i: v for i, v in enumerate(state['optimizer'])})
+        tmp = os.path.join(self.ckpt_dir, name + '.tmp.npz')
+        np.savez(tmp, num_weights=len(state['weights']), num_optimizer=len(state['optimizer']), es_wait=state['es_wait'], es_best=state['es_best'], **arrays)
+        os.replace(tmp, os.path.join(self.ckpt_dir, name))
+        entry = {'epoch': state['epoch'], 'file': name, 'value': state['value']}
+        checkpoints = [c for c in self.index['checkpoints'] if c['epoch'] != state['epoch']] + [entry]
+        best = entry if state['is_best'] else self.index['best']
+        keep = checkpoints[-self.keep_last:] + ([best] if best is not None else [])
+        keep_files = {c['file'] for c in keep}
+        for c in checkpoints:
+            if c['file'] not in keep_files:
+                os.remove(os.path.join(self.ckpt_dir, c['file']))
+        self.index = {'checkpoints': sorted({c['file']: c for c in keep}.values(), key=lambda c: c['epoch']), 'best': best, 'finished': False}
+        self._write_index()
+
+    def _write_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp, self.index_path)
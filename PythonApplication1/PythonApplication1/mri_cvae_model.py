@@ -0,0 +1,239 @@
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+## MRI CVAE model
+## The 3D conditional VAE from MRI_CVAE.py / MRI_CVAE_wholebrain.py as a function, so the same architecture can be rebuilt to load saved weights without re-running the training script ##
+## CVAE is a subclassed model with its own train_step/test_step: BCE is worked out on the decoder's logits (fused with the sigmoid), KL alongside it from the same forward pass ##
+## loss, reconstruction_loss and kl_loss (and their val_ versions) are reported as separate running means ##
+## A dataset with a third element ((x, y), x, mask), e.g. cohort_dataset(..., masks=...), restricts the reconstruction loss to the voxels inside the mask, the background doesn't dilute it ##
+## accumulate_steps=K splits each batch into K micro-batches inside train_step and sums their gradients before one optimizer step, so the batch (the effective batch) can be K times what fits in memory ##
+## recompute=True wraps the convolution blocks in Recompute, their activations are recomputed in the backward pass instead of kept (less memory, one more forward pass), benchmark_recompute.py measures it ##
+## training_mode switches on XLA for the step and/or the mixed_bfloat16 policy (bfloat16 convolutions, float32 weights and losses), benchmark_training.py compares them ##
+# Functions in this script:
+#   Sampling, Recompute, CVAE, build_cvae, bf16_supported, training_mode
+#   models = build_cvae(16, 40, 40, 1, n_y=5); encoder, decoder, cvae = models['encoder'], models['decoder'], models['cvae']
+
+class Sampling(layers.Layer):
+    """Uses (z_mean, z_log_var) to sample z, the vector encoding a digit."""
+    def __init__(self, stddev=0.1, **kwargs):
+        super().__init__(**kwargs)
+        self.stddev = stddev
+
+    def call(self, inputs):
+        z_mean, z_log_sigma = inputs
+        epsilon = tf.random.normal(shape=tf.shape(z_mean), mean=0., stddev=self.stddev, dtype=z_mean.dtype)
+        return z_mean + tf.exp(z_log_sigma) * epsilon
+
+class Recompute(layers.Layer):
+    ''' runs block (a list of layers) as one layer with tf.recompute_grad, only the block's input is kept for the backward pass
+        the layers in block can't be random (dropout stays outside, it would get a different mask when recomputed) '''
+    def __init__(self, block, **kwargs):
+        super().__init__(**kwargs)
+        self.block = block
+
+    def build(self, input_shape): # outside recompute_grad, so the weights aren't made inside it
+        for layer in self.block:
+            layer.build(input_shape)
+            input_shape = layer.compute_output_shape(input_shape)
+        self.built = True
+
+    def call(self, inputs):
+        def forward(x):
+            for layer in self.block:
+                x = layer(x)
+            return x
+        return tf.recompute_grad(forward)(inputs)
+
+    def compute_output_shape(self, input_shape):
+        for layer in self.block:
+            input_shape = layer.compute_output_shape(input_shape)
+        return input_shape
+
+class CVAE(keras.Model):
+    ''' encoder + decoder trained on origin_dim * mean BCE (from logits) + mean KL per subject
+        cvae([x, y]) / cvae.predict gives the sigmoid reconstruction like the old functional cvae, decoder_logits is the decoder without its sigmoid
+        accumulate_steps > 1 runs the forward/backward pass of a batch in that many micro-batches, one at a time, same loss and gradient as the whole batch (masked or not) '''
+    def __init__(self, encoder, decoder, decoder_logits, origin_dim=28*15, accumulate_steps=1, **kwargs):
+        super().__init__(**kwargs)
+        self.encoder = encoder
+        self.decoder = decoder
+        self.decoder_logits = decoder_logits
+        self.origin_dim = origin_dim
+        self.accumulate_steps = accumulate_steps
+        self.loss_tracker = keras.metrics.Mean(name='loss')
+        self.reconstruction_tracker = keras.metrics.Mean(name='reconstruction_loss')
+        self.kl_tracker = keras.metrics.Mean(name='kl_loss')
+
+    @property
+    def metrics(self): # reset by keras at the start of each epoch
+        return [self.loss_tracker, self.reconstruction_tracker, self.kl_tracker]
+
+    def call(self, inputs, training=None):
+        z_label = self.encoder(inputs, training=training)[2]
+        return tf.sigmoid(tf.cast(self.decoder_logits(z_label, training=training), tf.float32))
+
+    def compute_losses(self, x, y, training=None, mask=None):
+        ''' reconstruction and kl terms for one batch, one encoder and decoder pass, always in float32 whatever the compute dtype
+            mask (bool, shaped like x or without its channel axis) makes the reconstruction term the mean over in-mask voxels only '''
+        z_mean, z_log_sigma, z_label, _ = self.encoder([x, y], training=training)
+        logits = tf.cast(self.decoder_logits(z_label, training=training), tf.float32)
+        z_mean, z_log_sigma = tf.cast(z_mean, tf.float32), tf.cast(z_log_sigma, tf.float32)
+        x = tf.cast(x, tf.float32)
+        if mask is None:
+            reconstruction_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=x, logits=logits)) * self.origin_dim
+        else:
+            reconstruction_loss = self._masked_reconstruction(x, logits, mask) * self.origin_dim
+        kl_loss = -0.5 * tf.reduce_sum(1 + z_log_sigma - tf.square(z_mean) - tf.exp(z_log_sigma), axis=-1)
+        return reconstruction_loss, tf.reduce_mean(kl_loss)
+
+    def _masked_reconstruction(self, x, logits, mask):
+        ''' mean BCE over the voxels where mask is set, background voxels get no weight and don't count in the mean
+            a masked sum rather than gathering the in-mask voxels: same result, faster on the cpu (the gather's gradient is a dense scatter) and fine under XLA '''
+        weights = self._mask_weights(mask, x)
+        bce = tf.nn.sigmoid_cross_entropy_with_logits(labels=x, logits=logits)
+        return tf.reduce_sum(bce * weights) / tf.maximum(tf.reduce_sum(weights), 1.)
+
+    def _mask_weights(self, mask, x):
+        ''' mask as float32 weights shaped like x, a mask without the channel axis covers every channel '''
+        mask = tf.cast(mask, tf.float32)
+        if mask.shape.rank < x.shape.rank:
+            mask = tf.expand_dims(mask, -1)
+        return tf.broadcast_to(mask, tf.shape(x))
+
+    def _update(self, reconstruction_loss, kl_loss):
+        self.loss_tracker.update_state(reconstruction_loss + kl_loss)
+        self.reconstruction_tracker.update_state(reconstruction_loss)
+        self.kl_tracker.update_state(kl_loss)
+        return {m.name: m.result() for m in self.metrics}
+
+    def train_step(self, data):
+        (x, y), _ = data[:2] # ((image, onehot label), image) from the mri_pipeline / mri_tfrecord datasets
+        mask = data[2] if len(data) > 2 else None # ((image, onehot label), image, mask)
+        if self.accumulate_steps > 1:
+            return self._accumulated_step(x, y, mask)
+        with tf.GradientTape() as tape:
+            reconstruction_loss, kl_loss = self.compute_losses(x, y, training=True, mask=mask)
+            loss = reconstruction_loss + kl_loss
+            loss = loss / tf.distribute.get_strategy().num_replicas_in_sync # replicas' gradients are summed (train_parallel.py)
+        gradients = tape.gradient(loss, self.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return self._update(reconstruction_loss, kl_loss)
+
+    def _accumulated_step(self, x, y, mask=None):
+        ''' gradients of the batch summed over accumulate_steps micro-batches, each weighted by its share of the batch, then one optimizer step
+            with a mask the reconstruction term's share is the micro-batch's share of the in-mask voxels, so its mean is over the whole batch's voxels as without accumulating
+            only one micro-batch's activations are alive at a time, a last batch that doesn't split evenly gives a shorter last micro-batch '''
+        batch = tf.shape(x)[0]
+        micro = -(-batch // self.accumulate_steps) # ceil
+        replicas = tf.distribute.get_strategy().num_replicas_in_sync
+        voxels = None if mask is None else tf.maximum(tf.reduce_sum(self._mask_weights(mask, x)), 1.)
+
+        def micro_step(start, reconstruction_loss, kl_loss, gradients): # a tf.while_loop, so each micro-batch's activations are freed before the next
+            x_micro, y_micro = x[start:start + micro], y[start:start + micro]
+            mask_micro = None if mask is None else mask[start:start + micro]
+            share = tf.cast(tf.shape(x_micro)[0], tf.float32) / tf.cast(batch, tf.float32)
+            reconstruction_share = share if mask is None else tf.reduce_sum(self._mask_weights(mask_micro, x_micro)) / voxels
+            with tf.GradientTape() as tape:
+                micro_reconstruction, micro_kl = self.compute_losses(x_micro, y_micro, training=True, mask=mask_micro)
+                loss = (micro_reconstruction * reconstruction_share + micro_kl * share) / replicas
+            gradients = [g + m for g, m in zip(gradients, tape.gradient(loss, self.trainable_variables))]
+            return start + micro, reconstruction_loss + micro_reconstruction * reconstruction_share, kl_loss + micro_kl * share, gradients
+
+        _, reconstruction_loss, kl_loss, gradients = tf.while_loop(
+            lambda start, *_: start < batch, micro_step,
+            (tf.constant(0), tf.constant(0.), tf.constant(0.), [tf.zeros_like(v) for v in self.trainable_variables]),
+            parallel_iterations=1) # the next micro-batch's forward pass doesn't wait on the gradients, so without this iterations could overlap
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return self._update(reconstruction_loss, kl_loss)
+
+    def test_step(self, data):
+        (x, y), _ = data[:2]
+        return self._update(*self.compute_losses(x, y, training=False, mask=data[2] if len(data) > 2 else None))
+
+def build_cvae(depth=16, rows=40, cols=40, inchannel=1, n_y=5, latent_dim=50, origin_dim=28*15, learning_rate=0.001, beta_1=0.009, dropout=0.3, accumulate_steps=1, recompute=False, jit_compile=False, summary=True):
+    ''' returns {'encoder', 'decoder', 'cvae'}, cvae compiled with its reconstruction + KL train_step
+        depth, rows and cols are best multiples of 8 (three poolings), otherwise the decoder works on the next multiple up and crops its output back (the coarse-to-fine shapes), the mri_cvae roi is 16, 40, 40, dropout=0 leaves the SpatialDropout3D layers out (wholebrain)
+        accumulate_steps=K trains each batch as K micro-batches (batch_size is the effective batch), recompute=True puts the conv blocks in Recompute layers
+        (same weights, but saved weights only load into a model built with the same recompute), jit_compile=True compiles the train/test steps with XLA '''
+    def block(x, *block_layers): # conv (+ pooling / upsampling) block, one Recompute layer if recompute
+        if recompute:
+            return Recompute(list(block_layers))(x)
+        for layer in block_layers:
+            x = layer(x)
+        return x
+
+    # Encoder
+    label = keras.Input(shape=(n_y, )) # shape of length y_train
+    encoder_inputs = keras.Input(shape=(depth, rows, cols, inchannel)) # it will add a None layer as batch size
+    x = block(encoder_inputs, layers.Conv3D(32, (3, 3, 3), activation="relu", padding="same"), # relu turns negative values to 0
+              layers.MaxPooling3D(pool_size=(2, 2, 2))) # max pooling
+    x = block(x, layers.Conv3D(64, (3, 3, 3), activation="relu",  padding="same"),
+              layers.MaxPooling3D(pool_size=(2, 2, 2), padding ='same'))
+    if dropout:
+        x = layers.SpatialDropout3D(dropout)(x)
+    x = block(x, layers.Conv3D(128, (3, 3, 3), activation="relu",  padding="same"),
+              layers.MaxPooling3D(pool_size=(2, 2, 2), padding='same'))
+    x = layers.Flatten()(x) # to feed into sampling function
+    z_mean = layers.Dense(latent_dim, name="z_mean")(x)
+    z_log_sigma = layers.Dense(latent_dim, name="z_log_var")(x)
+    z = Sampling(name='z')([z_mean, z_log_sigma])
+    z_label = layers.concatenate([z, label], name='encoded')
+    ## initiating the encoder, it ouputs the latent dim dimensions
+    encoder = keras.Model([encoder_inputs, label], [z_mean, z_log_sigma, z_label, z], name="encoder")
+
+    #### Make the decoder, takes the latent keras
+    latent_inputs = keras.Input(shape=(latent_dim + n_y,)) # changes based on depth
+    grid = [-(-s // 8) for s in (depth, rows, cols)] # the same as depth // 8 etc. for multiples of 8
+    x =  layers.Dense(grid[0] * grid[1] * grid[2] * 128, activation='relu')(latent_inputs)
+    x = layers.Reshape((grid[0], grid[1], grid[2], 128))(x)
+    x = block(x, layers.UpSampling3D((2,2,2)), layers.Conv3DTranspose(64, (3, 3, 3), activation="relu",  padding="same"))
+    if dropout:
+        x = layers.SpatialDropout3D(dropout)(x)
+    x = block(x, layers.UpSampling3D((2,2,2)), layers.Conv3DTranspose(32, (3, 3, 3), activation="relu",  padding="same"),
+              layers.UpSampling3D((2,2,2)))
+    logits = layers.Conv3DTranspose(inchannel, 3, padding="same", name='logits')(x)
+    if [8 * g for g in grid] != [depth, rows, cols]: # trailing voxels past the shape, no weights so it doesn't change what loads
+        logits = layers.Cropping3D(tuple((0, 8 * g - s) for g, s in zip(grid, (depth, rows, cols))), name='crop')(logits)
+    # the decoder the analysis uses outputs images, the cvae trains on the logits underneath
+    decoder_logits = keras.Model(latent_inputs, logits, name="decoder_logits")
+    decoder = keras.Model(latent_inputs, layers.Activation('sigmoid', dtype='float32')(logits), name="decoder")
+
+    cvae = CVAE(encoder, decoder, decoder_logits, origin_dim=origin_dim, accumulate_steps=accumulate_steps, name='cvae')
+    cvae([tf.zeros((1, depth, rows, cols, inchannel)), tf.zeros((1, n_y))]) # builds it so weights can be loaded before training
+    if summary:
+        encoder.summary()
+        decoder.summary()
+        cvae.summary()
+    opt = keras.optimizers.Adam(learning_rate = learning_rate, beta_1 = beta_1)
+    cvae.compile(optimizer=opt, jit_compile=jit_compile)
+    return {'encoder': encoder, 'decoder': decoder, 'cvae': cvae}
+
+def bf16_supported():
+    ''' whether this machine computes bfloat16 natively (a gpu, or a cpu with avx512_bf16 / amx_bf16), otherwise it's emulated and slower than float32 '''
+    if tf.config.list_physical_devices('GPU'):
+        return True
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError: # windows, ask the cpuinfo package if it's there
+        try:
+            import cpuinfo
+            flags = ' '.join(cpuinfo.get_cpu_info().get('flags', []))
+        except ImportError:
+            return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def training_mode(mode='float32'):
+    ''' sets up a training mode, call it before build_cvae and pass on what it returns: build_cvae(..., **training_mode('xla_bf16'))
+        'float32' as before, 'xla' compiles the train/test step with XLA, 'bf16' the mixed_bfloat16 policy, 'xla_bf16' both
+        bfloat16 is only used if bf16_supported(), otherwise it stays float32 '''
+    if mode not in ('float32', 'xla', 'bf16', 'xla_bf16'):
+        raise ValueError('unknown training mode %s' % mode)
+    policy = 'float32'
+    if mode.endswith('bf16'):
+        if bf16_supported():
+            policy = 'mixed_bfloat16'
+        else:
+            print('no native bfloat16 here, training in float32')
+    keras.mixed_precision.set_global_policy(policy)
+    return {'jit_compile': mode.startswith('xla')}
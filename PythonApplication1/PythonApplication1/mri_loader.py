@@ -0,0 +1,88 @@
+import os
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import nibabel as nib #reading MR images
+## Loading
+## Reading the PRONIA niftis into the (num_subjs, depth, H, W) arrays the MRI models train on, shared by all the MRI scripts ##
+## Subjects are read in a pool of workers, results always come back in csv row order ##
+## proxy=True reads only the slab/crop voxels through nibabel's array proxy instead of the whole float64 volume ##
+## The cohort array is allocated once and every subject is written straight into its row (with any zero padding already in place) ##
+## A list of mri types (e.g. ['wp1', 'wp2', 'rp1']) loads them as channels, (num_subjs, depth, H, W, C), all of a subject's files are read by the same worker ##
+# Functions in this script:
+#   load_subject, load_subject_channels, cohort_shape, load_cohort
+
+def load_subject(nii_path, slab=(101, 117), crop=((20, 60), (50, 90)), proxy=False, dtype=np.float32, out=None):
+    ''' reads one nifti and returns the slab as depth, H, W (same layout as the old niis list)
+        slab is the (start, stop) coronal slice range (axis 1), crop is ((start, stop), (start, stop)) applied to each slice, None keeps the full 121*121 slice
+        proxy=True slices img.dataobj so only the slab and crop window are read and scaled, proxy=False is the old get_fdata path (float64 full volume)
+        out is an optional depth, H, W array (e.g. a row of the cohort array) written in place instead of returning a new one '''
+    nii = nib.load(nii_path)
+    rows, cols = (slice(None), slice(None)) if crop is None else (slice(*crop[0]), slice(*crop[1]))
+    if proxy:
+        nii = np.asarray(nii.dataobj[rows, slab[0]:slab[1], cols], dtype=dtype)
+    else:
+        nii = nii.get_fdata()
+        nii = nii[rows, slab[0]:slab[1], cols]
+    nii = np.transpose(nii, (1, 0, 2)) # depth first
+    if out is None:
+        return nii.astype(dtype, copy=False)
+    out[...] = nii
+    return out
+
+def load_subject_channels(nii_paths, slab=(101, 117), crop=((20, 60), (50, 90)), proxy=False, dtype=np.float32, out=None):
+    ''' reads one subject's niftis (one per modality) into depth, H, W, C, channel c is nii_paths[c] '''
+    if out is None:
+        return np.stack([load_subject(path, slab, crop, proxy, dtype) for path in nii_paths], axis=-1)
+    for c, path in enumerate(nii_paths):
+        load_subject(path, slab, crop, proxy, dtype, out=out[..., c])
+    return out
+
+def cohort_shape(paths, slab=(101, 117), crop=((20, 60), (50, 90)), pad=None):
+    ''' shape of the array load_cohort builds for these paths (reads one header if there's no crop), paths of tuples (one file per channel) add a channel axis '''
+    multi = isinstance(paths[0], (tuple, list))
+    if crop is None:
+        shape = nib.load(paths[0][0] if multi else paths[0]).shape
+        h, w = shape[0], shape[2]
+    else:
+        h, w = crop[0][1] - crop[0][0], crop[1][1] - crop[1][0]
+    if pad is not None:
+        h, w = h + sum(pad[0]), w + sum(pad[1])
+    shape = (len(paths), slab[1] - slab[0], h, w)
+    return shape + (len(paths[0]),) if multi else shape
+
+def load_cohort(filepath_df, num_subjs, mri_type='wp1', slab=(101, 117), crop=((20, 60), (50, 90)), label_col='STUDYGROUP', workers=None, executor='thread', proxy=False, dtype=np.float32, pad=None, out=None):
+    ''' loads the first num_subjs rows of filepath_df in parallel, returns images (num_subjs, depth, H, W) as dtype and the list of labels
+        mri_type can be a list of columns, then images are (num_subjs, depth, H, W, C) with the channels in that order
+        workers is the number of threads (None uses every core, 1 or 0 reads in this process), nibabel's reads and gzip release the gil so threads keep up
+        proxy=True reads only the slab and crop through the nifti array proxy (see load_subject), benchmark_loading.py compares the two
+        pad=((top, bottom), (left, right)) zero-pads every slice in place, ((3, 0), (3, 0)) takes 121*121 to 124*124
+        out is an optional preallocated array of cohort_shape to fill instead (e.g. np.lib.format.open_memmap), its padding must already be zero
+        executor='process' uses processes instead, on windows they re-import the calling script so it then needs an if __name__ == '__main__' guard
+        load_cohort(filepath_df, 698, 'wp1', (101, 117), ((20, 60), (50, 90)), workers=8) '''
+    rows = filepath_df.iloc[:num_subjs]
+    multi = isinstance(mri_type, (list, tuple))
+    paths = list(zip(*[rows[t] for t in mri_type])) if multi else list(rows[mri_type]) # one tuple of files per subject for channels
+    read = load_subject_channels if multi else load_subject
+    labels = list(rows[label_col])
+    shape = cohort_shape(paths, slab, crop)
+    pad = pad if pad is not None else ((0, 0), (0, 0))
+    images = out if out is not None else np.zeros(cohort_shape(paths, slab, crop, pad), dtype=dtype)
+    inner = images[:, :, pad[0][0]:pad[0][0] + shape[2], pad[1][0]:pad[1][0] + shape[3]] # view of the unpadded part, subjects are written into this
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        for i, path in enumerate(paths):
+            read(path, slab, crop, proxy, dtype, out=inner[i])
+    elif executor == 'thread':
+        # threads share the array so each one fills its own row
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda i: read(paths[i], slab, crop, proxy, dtype, out=inner[i]), range(len(paths))))
+    else:
+        chunksize = max(1, len(paths) // (workers * 4)) # few big chunks so workers aren't waiting on dispatch
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            # map keeps the input order so images line up with labels whatever order the workers finish in, each result is copied into its row then dropped
+            for i, nii in enumerate(ex.map(read, paths, repeat(slab), repeat(crop), repeat(proxy), repeat(dtype), chunksize=chunksize)):
+                inner[i] = nii
+    return images, labels
@@ -0,0 +1,90 @@
+import os
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib #reading MR images
+## Manifest
+## Index of every nifti in pronia_full_niftis.csv made from headers only (shape, dtype, affine, file size, mtime), so bad paths and odd shapes show up before loading starts ##
+## Re-running only re-reads headers of files whose size or mtime changed, valid_cohort drops the rows that can't be loaded ##
+# Functions in this script:
+#   scan_header, build_manifest, valid_cohort
+
+def scan_header(path):
+    ''' header-only record for one file, ok is False (with the error) if it's missing or unreadable '''
+    record = {'path': path, 'ok': False, 'error': None, 'shape': None, 'dtype': None, 'affine': None, 'size': None, 'mtime': None}
+    if not isinstance(path, str) or not path:
+        record['error'] = 'missing path'
+        return record
+    try:
+        stat = os.stat(path)
+        record['size'], record['mtime'] = stat.st_size, stat.st_mtime_ns
+        img = nib.load(path) # only the header is read until the data is asked for
+        record['shape'] = list(img.shape)
+        record['dtype'] = str(img.header.get_data_dtype())
+        record['affine'] = img.affine.round(6).tolist()
+        record['ok'] = True
+    except Exception as e: # anything nibabel can't open counts as invalid
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    return record
+
+def build_manifest(filepath_df, index_path=None, mri_types=('wp0', 'wp1', 'wp2', 'mwp2', 'rp1', 'rp2'), workers=16):
+    ''' scans the headers of every file in the mri_types columns and returns {path: record}, written to index_path as json if given
+        an existing index_path is reused, files with the same size and mtime aren't opened again
+        header reads are small and mostly waiting on the (network) drive, so they run in threads '''
+    old = {}
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path) as f:
+            old = json.load(f)['files']
+    paths = sorted({p for t in mri_types for p in filepath_df[t] if isinstance(p, str)})
+    files = {}
+    rescan = []
+    for path in paths:
+        record = old.get(path)
+        try:
+            stat = os.stat(path)
+            unchanged = record is not None and record['ok'] and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns
+        except OSError:
+            unchanged = False
+        if unchanged:
+            files[path] = record
+        else:
+            rescan.append(path)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for record in ex.map(scan_header, rescan):
+            files[record['path']] = record
+    print('manifest: %d files, %d rescanned, %d invalid' % (len(files), len(rescan), sum(not r['ok'] for r in files.values())))
+    manifest = {'mri_types': list(mri_types), 'files': files, 'index_path': index_path}
+    if index_path is not None:
+        tmp = index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp, index_path)
+    return manifest
+
+def valid_cohort(filepath_df, manifest, mri_type='wp1', shape=None, verbose=True):
+    ''' returns filepath_df without the rows whose mri_type file(s) are missing, unreadable or not the expected shape (the most common shape if None)
+        mri_type can be a list, a row is only kept if every modality is fine '''
+    types = list(mri_type) if isinstance(mri_type, (list, tuple)) else [mri_type]
+    files = manifest['files']
+    records = [[files.get(p) if isinstance(p, str) else None for p in filepath_df[t]] for t in types]
+    source = manifest.get('index_path') or 'the manifest'
+    if shape is None:
+        shapes = Counter(tuple(r['shape']) for recs in records for r in recs if r is not None and r['ok']).most_common(1)
+        if not shapes:
+            raise ValueError('no readable %s file in %s for the %d csv rows, check the paths in the csv' % ('/'.join(types), source, len(filepath_df)))
+        shape = shapes[0][0]
+    keep = []
+    for i in range(len(filepath_df)):
+        problems = []
+        for t, recs in zip(types, records):
+            r = recs[i]
+            if r is None or not r['ok']:
+                problems.append('%s %s' % (t, 'missing path' if r is None else r['error']))
+            elif tuple(r['shape']) != tuple(shape):
+                problems.append('%s shape %s' % (t, r['shape']))
+        keep.append(not problems)
+        if problems and verbose:
+            print('skipping row %d: %s' % (i, ', '.join(problems)))
+    if not any(keep):
+        raise ValueError('none of the %d csv rows has valid %s files of shape %s in %s' % (len(filepath_df), '/'.join(types), tuple(shape), source))
+    return filepath_df[keep].reset_index(drop=True)
@@ -0,0 +1,66 @@
+import numpy as np
+from tensorflow.keras import layers
+from mri_cvae_model import build_cvae
+from mri_pipeline import cohort_dataset
+## Coarse-to-fine training
+## The MRI_CVAE model is warmed up on resampled cohorts (mri_resample, e.g. 6mm then 3mm, 64x and 8x fewer voxels than 1.5mm) before its epochs at full resolution ##
+## Each stage builds the same architecture for that resolution's shape, conv kernels carry over as they are and the dense layers either side of the latent space are regridded: ##
+## every cell of the new bottleneck grid takes the weights of the coarse cell over the same part of the volume (the encoder's are shared out between the cells that take them) ##
+# Functions in this script:
+#   regrid, transfer_weights, warm_up
+#   histories = warm_up(models, [(6., 10), (3., 10)], lambda voxel: cached_cohort(..., resample=voxel)[0], labels, model_config, train_idx, test_idx)
+
+def regrid(grid, source_grid, shape, source_shape):
+    ''' per axis, the source bottleneck cell each cell of grid lies in, cells are 8 voxels from voxel 0 and both volumes cover the same extent '''
+    return [np.minimum(((8 * np.arange(g) + 4) * s / n // 8).astype(int), sg - 1) for g, sg, n, s in zip(grid, source_grid, shape, source_shape)]
+
+def _grids(models):
+    ''' the encoder's bottleneck grid (what's flattened) and the decoder's (what it reshapes to) '''
+    flatten = next(layer for layer in models['encoder'].layers if isinstance(layer, layers.Flatten))
+    reshape = next(layer for layer in models['decoder'].layers if isinstance(layer, layers.Reshape))
+    return tuple(flatten.input.shape[1:4]), tuple(reshape.target_shape[:3])
+
+def _regrid_dense(weights, cells, source_grid, spatial_input):
+    ''' a dense layer's kernel and bias with its bottleneck side (input for the encoder, output for the decoder) moved onto the cells '''
+    kernel, bias = weights
+    d, h, w = cells
+    if spatial_input: # grid * 128 -> latent, summed over the cells so shared out between the ones taking the same source cell
+        kernel = kernel.reshape(tuple(source_grid) + (-1, kernel.shape[-1]))[np.ix_(d, h, w)]
+        share = np.bincount(d)[d][:, None, None] * np.bincount(h)[h][None, :, None] * np.bincount(w)[w][None, None, :]
+        return [(kernel / share[..., None, None]).reshape(-1, kernel.shape[-1]), bias]
+    kernel = kernel.reshape((kernel.shape[0],) + tuple(source_grid) + (-1,))[:, d][:, :, h][:, :, :, w]
+    bias = bias.reshape(tuple(source_grid) + (-1,))[np.ix_(d, h, w)]
+    return [kernel.reshape(kernel.shape[0], -1), bias.ravel()]
+
+def transfer_weights(source, target):
+    ''' copies source's weights (build_cvae models) into target, the same config built for another input shape, returns target '''
+    source_shape, shape = source['encoder'].inputs[0].shape[1:4], target['encoder'].inputs[0].shape[1:4]
+    for part, source_grid, grid in zip(('encoder', 'decoder'), _grids(source), _grids(target)):
+        cells = regrid(grid, source_grid, shape, source_shape)
+        pairs = zip([layer for layer in source[part].layers if layer.weights], [layer for layer in target[part].layers if layer.weights])
+        for source_layer, layer in pairs:
+            weights = source_layer.get_weights()
+            if isinstance(layer, layers.Dense) and tuple(layer.kernel.shape) != tuple(source_layer.kernel.shape):
+                weights = _regrid_dense(weights, cells, source_grid, spatial_input=part == 'encoder')
+            layer.set_weights(weights)
+    return target
+
+def warm_up(models, stages, cohort, labels, model_config, train_idx, test_idx, batch_size=8, build_kwargs=None, callbacks=(), verbose=2):
+    ''' trains models (build_cvae(**model_config) at full resolution) coarse to fine, before its own fit
+        stages [(voxel, epochs), ...] coarsest first, cohort(voxel) gives the images at that voxel size (e.g. cached_cohort(..., resample=voxel)[0]), labels and the split are the same at every resolution
+        each stage starts from the previous stage's weights and the last stage's go into models (their optimizer starts fresh), build_kwargs go to build_cvae (accumulate_steps, training_mode)
+        returns each stage's history '''
+    histories, previous = [], None
+    for voxel, epochs in stages:
+        images = cohort(voxel)
+        stage = build_cvae(**dict(model_config, depth=images.shape[1], rows=images.shape[2], cols=images.shape[3]), summary=False, **(build_kwargs or {}))
+        if previous is not None:
+            transfer_weights(previous, stage)
+        train_ds = cohort_dataset(images, labels, batch_size, num_classes=model_config['n_y'], shuffle=True, indices=train_idx)
+        val_ds = cohort_dataset(images, labels, batch_size, num_classes=model_config['n_y'], shuffle=False, indices=test_idx)
+        print('warm up at %gmm, %s for %d epochs' % (voxel, 'x'.join(map(str, images.shape[1:4])), epochs))
+        histories.append(stage['cvae'].fit(train_ds, epochs=epochs, validation_data=val_ds, verbose=verbose, callbacks=list(callbacks)))
+        previous = stage
+    if previous is not None:
+        transfer_weights(previous, models)
+    return histories
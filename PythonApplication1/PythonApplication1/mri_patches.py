@@ -0,0 +1,41 @@
+import numpy as np
+from mri_roi import patch_grid, patch_position
+## Patch models, whole volumes back out of a CVAE trained on patches (mri_pipeline.patch_dataset) ##
+## Every subject is tiled with overlapping patches (a grid that covers the whole volume), each patch is encoded and decoded in batched predict calls ##
+## The decoded patches are blended with a smooth window (highest in the middle, never 0) and divided by the summed window, so there are no seams where patches meet ##
+# Functions in this script:
+#   blend_window, reconstruct_volumes
+#   recon = reconstruct_volumes(encoder, decoder, x_test, y_test, (32, 32, 32), stride=(16, 16, 16))
+
+def blend_window(patch):
+    ''' (depth, H, W) weights, a separable hann window shifted half a voxel so the edges get a small weight instead of 0 '''
+    axes = [0.5 - 0.5 * np.cos(2 * np.pi * (np.arange(p) + 0.5) / p) for p in patch]
+    return (axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]).astype(np.float32)
+
+def reconstruct_volumes(encoder, decoder, volumes, onehot, patch, stride=None, batch_size=64, sample=False):
+    ''' reconstructions of volumes (N, depth, H, W[, C]) from a patch cvae, onehot (N, num_classes) is each subject's label without the position
+        stride defaults to half the patch, the decoder gets z_mean (sample=False) or the sampled z with each patch's label + position
+        returns float32 shaped like volumes '''
+    patch = tuple(patch)
+    stride = tuple(p // 2 for p in patch) if stride is None else tuple(stride)
+    volume_shape = volumes.shape[1:4]
+    origins = patch_grid(volume_shape, patch, stride, cover=True)
+    positions = patch_position(origins, patch, volume_shape)
+    window = blend_window(patch)
+    window_sum = np.zeros(volume_shape, dtype=np.float32)
+    for d, h, w in origins: # the same for every subject
+        window_sum[d:d + patch[0], h:h + patch[1], w:w + patch[2]] += window
+    if volumes.ndim == 5:
+        window, window_sum = window[..., None], window_sum[..., None]
+    out = np.zeros(volumes.shape, dtype=np.float32)
+    for i in range(len(volumes)):
+        patches = np.stack([volumes[i, d:d + patch[0], h:h + patch[1], w:w + patch[2]] for d, h, w in origins]).astype(np.float32)
+        if patches.ndim == 4:
+            patches = patches[..., None]
+        condition = np.concatenate([np.repeat(np.asarray(onehot[i:i + 1], dtype=np.float32), len(origins), axis=0), positions], axis=1)
+        z_mean, _, _, z = encoder.predict([patches, condition], batch_size=batch_size, verbose=0)
+        decoded = decoder.predict(np.concatenate([z if sample else z_mean, condition], axis=1), batch_size=batch_size, verbose=0)
+        decoded = decoded.reshape((len(origins),) + patch + out.shape[4:]) # drops the channel axis for single modality volumes
+        for (d, h, w), rec in zip(origins, decoded):
+            out[i, d:d + patch[0], h:h + patch[1], w:w + patch[2]] += rec * window
+    return out / window_sum
@@ -0,0 +1,177 @@
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from mri_loader import load_subject
+from mri_roi import patch_position
+from mri_quantise import QuantisedCohort
+## Input pipeline
+## tf.data builders that stream subjects into cvae.fit in float32 batches instead of handing keras the whole cohort as numpy arrays ##
+## Elements are ((image, onehot label), image) with image shaped depth, H, W, C, the same inputs the MRI CVAEs were fit on (C=1 for a single modality) ##
+## cohort_dataset(..., masks=) adds a third element, the bool brain mask shaped like the image, which the CVAE's train_step scores the reconstruction inside ##
+## patch_dataset gives random 3D patches instead of whole images, their condition is the onehot label followed by the patch's position (mri_roi.patch_position) ##
+# Functions in this script:
+#   epoch_seeds, cohort_dataset, patch_dataset, nifti_dataset, InputStallTimer
+#   cvae.fit(cohort_dataset(x_train, train_label, 8, n_y), validation_data=cohort_dataset(x_test, test_label, 8, n_y, shuffle=False), callbacks=[InputStallTimer()])
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+def _onehot(labels, num_classes):
+    ''' labels as float32 onehot, matches to_categorical '''
+    labels = np.asarray(labels, dtype=np.int64)
+    if num_classes is None:
+        num_classes = int(labels.max()) + 1
+    return np.eye(num_classes, dtype=np.float32)[labels]
+
+def epoch_seeds(seed=13, rerandomize=True):
+    ''' endless dataset of stateless seeds (int64 pairs), one per element, a new sequence each time it's iterated (every epoch) if rerandomize, the same one otherwise
+        element i of epoch e is stateless_split of (seed, e) then of i, instead of Dataset.random(rerandomize_each_iteration=...) which needs tf >= 2.13 '''
+    epoch = tf.Variable(-1, dtype=tf.int64, trainable=False) # counts the iterations, bumped once at the start of each one
+
+    def epoch_key(_):
+        e = epoch.assign_add(1) if rerandomize else tf.constant(0, tf.int64)
+        return tf.random.experimental.stateless_split(tf.stack([tf.constant(seed, tf.int64), e]), num=1)[0]
+
+    def element_seeds(key):
+        return tf.data.Dataset.range(2 ** 62).map(lambda i: tf.random.experimental.stateless_split(tf.stack([key[0], tf.bitwise.bitwise_xor(key[1], i)]), num=1)[0])
+
+    return tf.data.Dataset.from_tensors(0).map(epoch_key).flat_map(element_seeds)
+
+def _finish(ds):
+    ''' shapes each batch into the ((x, y), x) keras expects, ((x, y), x, mask) if there are masks, and prefetches so the next batch is ready while the model trains '''
+    def to_inputs(x, y, mask=None):
+        if len(x.shape) == 4: # single modality, add the channel axis
+            x = tf.expand_dims(x, -1)
+        if mask is None:
+            return (x, y), x
+        return (x, y), x, tf.expand_dims(mask, -1) # one mask for every channel
+    ds = ds.map(to_inputs, num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+def cohort_dataset(images, labels, batch_size=8, num_classes=None, shuffle=True, seed=13, indices=None, masks=None):
+    ''' streams batches out of an in-memory or memory-mapped cohort array (e.g. from cached_cohort) without converting it to a tensor first
+        only the subject indices are shuffled, each batch is gathered from images in a parallel map, so a memmap larger than RAM is read a batch at a time
+        indices optionally restricts the dataset to those rows (e.g. a train split)
+        a QuantisedCohort (mri_quantise) is gathered as its uint8 / float16 codes and dequantised to float32 per batch in the graph
+        masks (N, depth, H, W) per subject (e.g. mri_cache.cached_mask) or one depth, H, W mask for everyone adds each image's bool mask as a third element '''
+    indices = np.arange(len(images)) if indices is None else np.asarray(indices)
+    onehot = _onehot(labels, num_classes)
+    num_classes = onehot.shape[1]
+    sample_shape = tuple(images.shape[1:])
+    quantised = isinstance(images, QuantisedCohort)
+    source = images.codes if quantised else images
+    source_dtype = tf.as_dtype(source.dtype) if quantised else tf.float32
+    shared_mask = masks is not None and np.ndim(masks) == 3
+
+    def gather(idx):
+        idx = np.sort(idx) # sorted reads are sequential in a memmap, order inside a batch doesn't matter
+        x = np.asarray(source[idx], dtype=source_dtype.as_numpy_dtype)
+        if masks is None:
+            return x, onehot[idx]
+        mask = np.broadcast_to(masks, (len(idx),) + np.shape(masks)) if shared_mask else masks[idx]
+        return x, onehot[idx], np.asarray(mask, dtype=bool)
+
+    def gather_batch(idx):
+        out = tf.numpy_function(gather, [idx], [source_dtype, tf.float32] + ([] if masks is None else [tf.bool]))
+        x, y = out[0], out[1]
+        x.set_shape((None,) + sample_shape)
+        y.set_shape((None, num_classes))
+        if quantised:
+            x = tf.cast(x, tf.float32) * images.scale + images.offset
+        if masks is None:
+            return x, y
+        out[2].set_shape((None,) + sample_shape[:3])
+        return x, y, out[2]
+
+    ds = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        ds = ds.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size).map(gather_batch, num_parallel_calls=AUTOTUNE)
+    return _finish(ds)
+
+def patch_dataset(images, labels, patch, batch_size=8, num_classes=None, shuffle=True, seed=13, indices=None, patches_per_subject=1):
+    ''' random patch (depth, H, W) sized patches from anywhere in the cohort's volumes, patches_per_subject of them per subject each epoch
+        the condition y is onehot label + patch_position (num_classes + 3 long), so the model has n_y=num_classes + 3
+        shuffle=False gives the same patches every epoch (validation), otherwise new ones, both depend only on seed '''
+    indices = np.arange(len(images)) if indices is None else np.asarray(indices)
+    onehot = _onehot(labels, num_classes)
+    num_classes = onehot.shape[1]
+    patch = tuple(patch)
+    volume_shape = tuple(images.shape[1:4])
+    positions = tf.constant([s - p + 1 for s, p in zip(volume_shape, patch)], tf.float32) # how many origins fit along each axis
+
+    def random_origin(idx, draw): # origin of the patch, uniform over the whole volume
+        unit = tf.random.stateless_uniform((3,), seed=draw)
+        return idx, tf.cast(unit * positions, tf.int64)
+
+    def gather(idx, origins):
+        x = np.empty((len(idx),) + patch + tuple(images.shape[4:]), dtype=np.float32)
+        for i, (subject, (d, h, w)) in enumerate(zip(idx, origins)):
+            x[i] = images[subject, d:d + patch[0], h:h + patch[1], w:w + patch[2]]
+        return x, np.concatenate([onehot[idx], patch_position(origins, patch, volume_shape)], axis=1)
+
+    def gather_batch(idx, origins):
+        x, y = tf.numpy_function(gather, [idx, origins], [tf.float32, tf.float32])
+        x.set_shape((None,) + patch + tuple(images.shape[4:]))
+        y.set_shape((None, num_classes + 3))
+        return x, y
+
+    ds = tf.data.Dataset.from_tensor_slices(np.repeat(indices, patches_per_subject))
+    if shuffle:
+        ds = ds.shuffle(len(indices) * patches_per_subject, seed=seed, reshuffle_each_iteration=True)
+    draws = epoch_seeds(seed, rerandomize=shuffle)
+    ds = tf.data.Dataset.zip((ds, draws)).map(random_origin)
+    ds = ds.batch(batch_size).map(gather_batch, num_parallel_calls=AUTOTUNE)
+    return _finish(ds)
+
+def nifti_dataset(paths, labels, batch_size=8, num_classes=None, slab=(101, 117), crop=((20, 60), (50, 90)), norm=(0., 1.), shuffle=True, seed=13, shuffle_buffer=256):
+    ''' streams subjects straight from the nifti files, decoding and cropping in a parallel map (proxy reads, float32), nothing is kept in memory between epochs
+        norm is the (min, max) used for min-max normalisation, it has to come from the training cohort '''
+    onehot = _onehot(labels, num_classes)
+    num_classes = onehot.shape[1]
+    depth = slab[1] - slab[0]
+    mi, m = float(norm[0]), float(norm[1])
+
+    def read(path):
+        nii = load_subject(path.decode(), slab, crop, proxy=True, dtype=np.float32)
+        return (nii - np.float32(mi)) / np.float32(m - mi)
+
+    def read_subject(path, y):
+        x = tf.numpy_function(read, [path], tf.float32)
+        x.set_shape((depth, None, None) if crop is None else (depth, crop[0][1] - crop[0][0], crop[1][1] - crop[1][0]))
+        return x, y
+
+    ds = tf.data.Dataset.from_tensor_slices((np.asarray(paths, dtype=str), onehot))
+    if shuffle:
+        ds = ds.shuffle(min(len(paths), shuffle_buffer), seed=seed, reshuffle_each_iteration=True) # shuffling paths, so the buffer is cheap
+    ds = ds.map(read_subject, num_parallel_calls=AUTOTUNE).batch(batch_size)
+    return _finish(ds)
+
+class InputStallTimer(keras.callbacks.Callback):
+    ''' measures how long each epoch spent waiting on the input pipeline, the gap between one train batch ending and the next starting
+        adds input_stall (seconds) and input_stall_frac to the epoch logs, so they show up in history and tensorboard '''
+    def __init__(self, verbose=1):
+        super().__init__()
+        self.verbose = verbose
+        self.stall_times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.stall = 0.
+        self.last_end = None
+        self.epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        self.stall += now - (self.last_end if self.last_end is not None else self.epoch_start)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.last_end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        total = (self.last_end or time.perf_counter()) - self.epoch_start
+        self.stall_times.append(self.stall)
+        if logs is not None:
+            logs['input_stall'] = self.stall
+            logs['input_stall_frac'] = self.stall / total if total > 0 else 0.
+        if self.verbose:
+            print('epoch %d input stall %.2fs (%.1f%% of training time)' % (epoch + 1, self.stall, 100 * self.stall / max(total, 1e-9)))
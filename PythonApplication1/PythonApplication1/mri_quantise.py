@@ -0,0 +1,99 @@
+import os
+import json
+import numpy as np
+## Quantised cohorts
+## Normalised images stored as uint8 (4x smaller than float32) or float16 (2x), with one scale and offset per cohort (per channel for stacked modalities) ##
+## image = code * scale + offset, uint8 codes are rounded so the error is at most scale / 2, float16 codes hold (image - offset) / scale in 0-1 so at most scale * 2**-12 ##
+## QuantisedCohort looks like the float32 array (shape, indexing, np.asarray) and dequantises only what's indexed, mri_pipeline.cohort_dataset dequantises each batch in the tf graph ##
+# Functions in this script:
+#   QuantisedCohort, quantise, save_quantised, load_quantised
+#   images = quantise(images, 'uint8'); print(images.max_error, images.error_bound)
+
+class QuantisedCohort:
+    ''' codes (uint8 or float16, in memory or memory-mapped) with scale and offset (floats, or (C,) arrays for channel-stacked cohorts)
+        indexing gives float32 images, e.g. images[idx] for a batch, the codes themselves are never converted as a whole '''
+    def __init__(self, codes, scale, offset, max_error=None):
+        self.codes = codes
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+        self.max_error = max_error # measured when quantising, None if unknown
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def ndim(self):
+        return self.codes.ndim
+
+    @property
+    def dtype(self): # what indexing gives back
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    @property
+    def error_bound(self):
+        ''' the largest difference to the original images quantisation can make (give or take float32 rounding), per channel if there are per channel scales '''
+        return self.scale / 2 if self.codes.dtype == np.uint8 else self.scale * 2. ** -12
+
+    def __len__(self):
+        return len(self.codes)
+
+    def dequantise(self, codes):
+        return codes.astype(np.float32) * self.scale + self.offset
+
+    def __getitem__(self, key):
+        return self.dequantise(self.codes[key])
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.dequantise(np.asarray(self.codes))
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+def quantise(images, dtype='uint8', out=None, chunk=32):
+    ''' QuantisedCohort of images (N, depth, H, W[, C]), worked through chunk subjects at a time so no full float copy is made
+        out is an optional preallocated codes array (e.g. np.lib.format.open_memmap) shaped like images, with dtype uint8 or float16
+        the scale and offset come from the cohort's min and max, per channel when images have a channel axis '''
+    dtype = np.dtype(dtype)
+    if dtype not in (np.uint8, np.float16):
+        raise ValueError('quantise to uint8 or float16, not %s' % dtype)
+    axes = tuple(range(images.ndim - 1)) if images.ndim == 5 else None # per channel for stacked modalities
+    low = np.min([np.min(images[i:i + chunk], axis=axes) for i in range(0, len(images), chunk)], axis=0).astype(np.float32)
+    high = np.max([np.max(images[i:i + chunk], axis=axes) for i in range(0, len(images), chunk)], axis=0).astype(np.float32)
+    span = np.where(high > low, high - low, 1).astype(np.float32) # a constant cohort still round trips
+    scale = span / 255 if dtype == np.uint8 else span
+    codes = np.empty(images.shape, dtype=dtype) if out is None else out
+    cohort = QuantisedCohort(codes, scale, low)
+    max_error = 0.
+    for i in range(0, len(images), chunk):
+        x = np.asarray(images[i:i + chunk], dtype=np.float32)
+        q = (x - cohort.offset) / cohort.scale
+        codes[i:i + chunk] = np.clip(np.rint(q), 0, 255) if dtype == np.uint8 else q
+        max_error = max(max_error, float(np.max(np.abs(cohort[i:i + chunk] - x))))
+    cohort.max_error = max_error
+    return cohort
+
+def save_quantised(folder, images, dtype='uint8', name='images'):
+    ''' quantises images straight into folder/name_dtype.npy (written as a memmap) with its scale, offset and errors in name_dtype.json, returns the QuantisedCohort (memory-mapped) '''
+    base = os.path.join(folder, '%s_%s' % (name, np.dtype(dtype).name))
+    codes = np.lib.format.open_memmap(base + '.npy.tmp', mode='w+', dtype=dtype, shape=images.shape)
+    cohort = quantise(images, dtype, out=codes)
+    info = {'dtype': np.dtype(dtype).name, 'scale': cohort.scale.tolist(), 'offset': cohort.offset.tolist(),
+            'max_error': cohort.max_error, 'error_bound': cohort.error_bound.tolist()}
+    codes.flush()
+    del codes, cohort # close the memmap before it's renamed
+    os.replace(base + '.npy.tmp', base + '.npy')
+    with open(base + '.json', 'w') as f: # written last, a .npy without one is an unfinished save
+        json.dump(info, f, indent=1)
+    return load_quantised(folder, dtype, name)
+
+def load_quantised(folder, dtype='uint8', name='images', mmap=True):
+    ''' the QuantisedCohort saved by save_quantised, None if there isn't one '''
+    base = os.path.join(folder, '%s_%s' % (name, np.dtype(dtype).name))
+    if not os.path.exists(base + '.json'):
+        return None
+    with open(base + '.json') as f:
+        info = json.load(f)
+    return QuantisedCohort(np.load(base + '.npy', mmap_mode='r' if mmap else None), info['scale'], info['offset'], info['max_error'])
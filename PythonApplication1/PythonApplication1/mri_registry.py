@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import sys
+import subprocess
+from types import SimpleNamespace
+import numpy as np
+## Model registry
+## A trained run lives in its model_dir: encoder/decoder/cvae weights, run.json (data and model config, cohort cache key, training history), split.npz and normalisation.json ##
+## Analysis loads a run (rebuilt model + the cached cohort as a memmap) in seconds instead of importing the training script, which retrains on import ##
+## load_or_train only runs the training script (as its own python process) if there's no saved run or retrain=True ##
+# Functions in this script:
+#   save_run, has_run, load_run, load_or_train
+#   cvae = load_or_train('C:/Users/Mischa/sophie/models/MRI_CVAE', 'MRI_CVAE.py', build_cvae)
+
+def save_run(model_dir, models, config, history=None):
+    ''' saves each model's weights ({'encoder': encoder, ...} as name.weights.h5) and run.json with config and the history of cvae.fit
+        config needs 'model' (build function keyword arguments) and 'data' (with cache_dir and cache_key, and quantise / sparse if the cohort was stored that way), anything else is kept as is '''
+    os.makedirs(model_dir, exist_ok=True)
+    for name, model in models.items():
+        model.save_weights(os.path.join(model_dir, name + '.weights.h5'))
+    history = getattr(history, 'history', history) or {}
+    run = dict(config, models=list(models), history={k: [float(v) for v in vals] for k, vals in history.items()}, saved=time.strftime('%Y-%m-%d %H:%M:%S'))
+    # run.json is written last, so a folder without one is an unfinished save
+    tmp = os.path.join(model_dir, 'run.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(run, f, indent=1)
+    os.replace(tmp, os.path.join(model_dir, 'run.json'))
+    return run
+
+def has_run(model_dir):
+    return os.path.exists(os.path.join(model_dir, 'run.json'))
+
+def load_run(model_dir, build, mmap=True):
+    ''' rebuilds the models with build(**config['model']) (e.g. build_cvae) and loads their weights, opens the cached cohort and the saved split
+        returns a namespace with the names the training script had: encoder, decoder, cvae, images, labels, train_idx, test_idx,
+        x_train, x_test (CohortView), train_label, test_label, y_train, y_test, history (.history like a keras History) and config '''
+    from mri_cache import open_cached
+    from mri_split import load_split, CohortView
+    with open(os.path.join(model_dir, 'run.json')) as f:
+        run = json.load(f)
+    models = build(**dict(run['model'], summary=False))
+    for name in run['models']:
+        models[name].load_weights(os.path.join(model_dir, name + '.weights.h5'))
+    images, labels = open_cached(run['data']['cache_dir'], run['data']['cache_key'], mmap, quantise=run['data'].get('quantise'), sparse=run['data'].get('sparse'))
+    train_idx, test_idx, _, _ = load_split(os.path.join(model_dir, 'split.npz'))
+    train_label, test_label = [labels[i] for i in train_idx], [labels[i] for i in test_idx]
+    eye = np.eye(run['model']['n_y'], dtype=np.float32) # onehot, same as to_categorical
+    return SimpleNamespace(**models, images=images, labels=labels, train_idx=train_idx, test_idx=test_idx,
+                           x_train=CohortView(images, train_idx), x_test=CohortView(images, test_idx),
+                           train_label=train_label, test_label=test_label, y_train=eye[train_label], y_test=eye[test_label],
+                           history=SimpleNamespace(history=run['history']), config=run)
+
+def load_or_train(model_dir, train_script, build, retrain=False, mmap=True):
+    ''' load_run(model_dir, build), running train_script first (it has to save_run into model_dir) if there's no run there or retrain=True
+        retrain=True clears model_dir's checkpoints first (mri_checkpoint), the script trains from scratch
+        the script runs in a child python process, not in this one, so the caller is never re-imported by a pool the script starts and the training memory is freed before loading '''
+    if retrain or not has_run(model_dir):
+        if retrain: # the last run's checkpoints would be resumed otherwise
+            from mri_checkpoint import clear_checkpoints
+            clear_checkpoints(model_dir)
+        print('training', train_script, 'into', model_dir)
+        subprocess.run([sys.executable, os.path.abspath(train_script)], cwd=os.path.dirname(os.path.abspath(train_script)), check=True)
+    return load_run(model_dir, build, mmap)
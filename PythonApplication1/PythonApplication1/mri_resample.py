@@ -0,0 +1,65 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib #reading MR images
+from scipy import ndimage
+## Resampling
+## Cohorts resampled to bigger voxels (e.g. 3mm and 6mm from the 1.5mm PRONIA niftis) for coarse-to-fine training, 8x and 64x fewer voxels ##
+## Each volume is gaussian smoothed first (sigma (factor - 1) / 2 voxels, as skimage's anti_aliasing) so detail finer than the new voxels doesn't alias, then linearly resampled ##
+## Subjects are resampled in a thread pool (scipy.ndimage releases the gil) and written into name_<voxel>mm.npy next to the full resolution images (the cache entry), a json says the voxel size and factors ##
+# Functions in this script:
+#   voxel_size, resampled_shape, resample_volume, save_resampled, load_resampled
+#   coarse = save_resampled(entry, images, 3., voxel_size(filepath_df['wp1'][0]), workers=8)
+
+def voxel_size(nii_path):
+    ''' the nifti's voxel size in mm in cohort axis order (depth, H, W), from the header only '''
+    zooms = nib.load(nii_path).header.get_zooms()
+    return (float(zooms[1]), float(zooms[0]), float(zooms[2])) # load_subject puts axis 1 first
+
+def resampled_shape(shape, factors):
+    ''' depth, H, W[, C] after resampling by factors (new voxel / old voxel per axis), at least 1 voxel an axis '''
+    return tuple(max(1, int(round(s / f))) for s, f in zip(shape[:3], factors)) + tuple(shape[3:])
+
+def resample_volume(volume, factors, out=None):
+    ''' volume (depth, H, W[, C]) resampled to factors times the voxel size, anti-aliased, channels are resampled separately
+        voxel centres are kept in place (grid_mode), edges are extended rather than faded to 0 '''
+    volume = np.asarray(volume, dtype=np.float32)
+    factors = tuple(factors)
+    shape = resampled_shape(volume.shape, factors)
+    sigma = [max(0., (f - 1) / 2) for f in factors] + [0.] * (volume.ndim - 3)
+    zoom = [n / s for n, s in zip(shape, volume.shape)]
+    smoothed = ndimage.gaussian_filter(volume, sigma, mode='nearest') if any(sigma) else volume
+    out = np.empty(shape, dtype=np.float32) if out is None else out
+    ndimage.zoom(smoothed, zoom, output=out, order=1, mode='nearest', grid_mode=True)
+    return out
+
+def save_resampled(folder, images, voxel, source_voxel=1.5, name='images', workers=None):
+    ''' resamples images (N, depth, H, W[, C], source_voxel mm, one number or per axis) to voxel mm into folder/name_<voxel>mm.npy, returns it memory-mapped
+        each thread writes its subjects straight into their rows, workers=None uses every core, 1 or 0 works in this thread
+        threads rather than processes, so scripts calling this at module level don't need a __main__ guard on windows '''
+    source_voxel = np.broadcast_to(np.asarray(source_voxel, dtype=float), (3,))
+    factors = tuple(float(f) for f in voxel / source_voxel)
+    base = os.path.join(folder, '%s_%gmm' % (name, voxel))
+    out = np.lib.format.open_memmap(base + '.npy.tmp', mode='w+', dtype=np.float32, shape=(len(images),) + resampled_shape(images.shape[1:], factors))
+    workers = min(workers or os.cpu_count() or 1, len(images))
+    if workers <= 1:
+        for i in range(len(images)):
+            resample_volume(images[i], factors, out=out[i])
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda i: resample_volume(images[i], factors, out=out[i]), range(len(images))))
+    shape = out.shape
+    out.flush()
+    del out # close the memmap before it's renamed
+    os.replace(base + '.npy.tmp', base + '.npy')
+    with open(base + '.json', 'w') as f: # written last, a .npy without one is an unfinished save
+        json.dump({'voxel': voxel, 'source_voxel': source_voxel.tolist(), 'factors': list(factors), 'shape': list(shape)}, f, indent=1)
+    return load_resampled(folder, voxel, name)
+
+def load_resampled(folder, voxel, name='images', mmap=True):
+    ''' the images saved by save_resampled at voxel mm, None if there aren't any '''
+    base = os.path.join(folder, '%s_%gmm' % (name, voxel))
+    if not os.path.exists(base + '.json'):
+        return None
+    return np.load(base + '.npy', mmap_mode='r' if mmap else None)
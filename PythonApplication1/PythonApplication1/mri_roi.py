@@ -0,0 +1,126 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+## ROIs and patches
+## Named 3D boxes replacing the crops hard-coded in each script, and a regular patch grid (patch size + stride) over a batch of volumes ##
+## Boxes are ((depth start, stop), (row start, stop), (col start, stop)) in cohort array order, depth is the nifti's coronal axis (axis 1) ##
+## Patches come out of one strided view over the whole batch, no per-slice python loops ##
+## bounding_box / mask_box find the tightest box around every subject's brain (non-zero voxels, or the rp1/rp2 masks), roi_args takes the box in place of a hand-picked crop ##
+# Functions in this script:
+#   roi_args, roi_shape, fit_box, bounding_box, mask_box, extract_box, patch_grid, patch_position, extract_patches
+
+rois = {'mri_cvae': {'box': ((101, 117), (20, 60), (50, 90))}, # 16 slices with most variance, MRI_CVAE.py
+        'wholebrain': {'box': ((35, 51), (20, 100), (10, 90))}, # MRI_CVAE_wholebrain.py
+        'mri_vae': {'box': ((78, 80), None, None), 'pad': ((3, 0), (3, 0))}, # whole 121*121 slices padded to 124*124, MRI_VAE.py
+        'brain': {'box': ((0, 145), (12, 108), (2, 98))}, # whole brain
+        'full': {'box': ((0, 144), None, None), 'pad': ((4, 3), (4, 3))}} # whole 121*145*121 volume, last (empty) coronal slice left out and padded to 144*128*128 so it divides by 8
+volume_shape = (145, 121, 121) # a 121*145*121 nifti in cohort array order
+
+def roi_args(name_or_box, pad=None):
+    ''' slab, crop (and pad) keyword arguments for load_cohort / cached_cohort from a named roi or a box
+        load_cohort(filepath_df, 698, 'wp1', **roi_args('mri_cvae')) '''
+    roi = rois[name_or_box] if isinstance(name_or_box, str) else {'box': name_or_box, 'pad': pad}
+    (slab, rows, cols) = roi['box']
+    args = {'slab': tuple(slab), 'crop': None if rows is None else (tuple(rows), tuple(cols))}
+    if roi.get('pad') is not None:
+        args['pad'] = roi['pad']
+    return args
+
+def roi_shape(name_or_box, pad=None):
+    ''' depth, H, W of the cohort array an roi loads, padding included '''
+    roi = rois[name_or_box] if isinstance(name_or_box, str) else {'box': name_or_box, 'pad': pad}
+    shape = [size if b is None else b[1] - b[0] for b, size in zip(roi['box'], volume_shape)]
+    for axis, p in zip((1, 2), roi.get('pad') or ()):
+        shape[axis] += sum(p)
+    return tuple(shape)
+
+def fit_box(box, shape=volume_shape, margin=0, multiple=None):
+    ''' box grown by margin voxels a side and then to a multiple of multiple (e.g. 8 for the CVAEs' three poolings), kept inside shape
+        an axis that can't grow to a multiple inside shape is cut down to one instead, from both ends '''
+    fitted = []
+    for (start, stop), size in zip(box, shape):
+        start, stop = max(0, start - margin), min(size, stop + margin)
+        if multiple:
+            length = -(-(stop - start) // multiple) * multiple
+            if length > size:
+                length = size // multiple * multiple
+            start = min(max(0, (start + stop - length) // 2), size - length) # centred on the box
+            stop = start + length
+        fitted.append((int(start), int(stop)))
+    return tuple(fitted)
+
+def _volume_box(volume, threshold=0.):
+    ''' (start, stop) along depth, H, W of the voxels above threshold in one depth, H, W[, C] volume, None if there are none '''
+    inside = volume > threshold
+    if inside.ndim == 4:
+        inside = inside.any(axis=-1)
+    if not inside.any():
+        return None
+    box = []
+    for axis in range(3):
+        hits = np.flatnonzero(inside.any(axis=tuple(a for a in range(3) if a != axis)))
+        box.append((int(hits[0]), int(hits[-1]) + 1))
+    return box
+
+def _union(boxes, shape):
+    ''' the box around every box, the whole of shape if they're all None (nothing above threshold anywhere, e.g. empty masks) '''
+    boxes = [b for b in boxes if b is not None]
+    if not boxes:
+        print('warning: no voxels above threshold in any subject, using the whole %s volume' % 'x'.join(map(str, shape)))
+        return tuple((0, int(size)) for size in shape)
+    return tuple((min(b[a][0] for b in boxes), max(b[a][1] for b in boxes)) for a in range(3))
+
+def bounding_box(volumes, threshold=0., margin=0, multiple=None):
+    ''' the smallest box (in volumes' own depth, H, W) holding every voxel above threshold in any subject of volumes (N, depth, H, W[, C]), then fit_box
+        read one subject at a time, so volumes can be a memmap '''
+    box = _union([_volume_box(np.asarray(v), threshold) for v in volumes], volumes.shape[1:4])
+    return fit_box(box, volumes.shape[1:4], margin, multiple)
+
+def mask_box(filepath_df, num_subjs, mask_types=('rp1', 'rp2'), threshold=0.5, margin=2, multiple=8, workers=None):
+    ''' bounding box in cohort array order over the whole volumes of every subject's masks (a union over mask_types), for roi_args in place of a named roi
+        the masks are read whole (proxy reads, one subject per worker at a time), nothing is kept but each subject's box
+        roi = mask_box(filepath_df, 698); cached_cohort(filepath_df, 698, cache_dir, 'wp1', **roi_args(roi)) '''
+    from concurrent.futures import ThreadPoolExecutor
+    from mri_loader import load_subject
+    rows = filepath_df.iloc[:num_subjs]
+    paths = [path for t in mask_types for path in rows[t]]
+
+    def read_box(path):
+        return _volume_box(load_subject(path, slab=(0, volume_shape[0]), crop=None, proxy=True), threshold)
+
+    with ThreadPoolExecutor(workers) as pool: # nibabel reads release the gil
+        boxes = list(pool.map(read_box, paths))
+    return fit_box(_union(boxes, volume_shape), volume_shape, margin, multiple)
+
+def extract_box(volumes, box):
+    ''' a view of box out of volumes (N, depth, H, W[, C]) that are already loaded, None in box keeps that whole axis '''
+    index = tuple(slice(None) if b is None else slice(*b) for b in box)
+    return volumes[(slice(None),) + index]
+
+def patch_grid(shape, patch, stride=None, cover=False):
+    ''' origins (P, 3) of a regular grid of patches over a depth, H, W volume, stride defaults to patch (no overlap), the last row/col that doesn't fit is left out
+        cover=True adds a last row/col flush with the far edge instead, so every voxel is in a patch (for stitching a whole volume back together) '''
+    stride = patch if stride is None else stride
+    ranges = [np.arange(0, s - p + 1, st) for s, p, st in zip(shape, patch, stride)]
+    if cover:
+        ranges = [r if r[-1] == s - p else np.append(r, s - p) for r, s, p in zip(ranges, shape, patch)]
+    return np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+
+def patch_position(origins, patch, shape):
+    ''' where patches are in the volume as (P, 3) float32, each patch's centre over the volume's size (0 to 1 along depth, H, W), what patch models are conditioned on '''
+    return ((np.asarray(origins) + np.asarray(patch) / 2.) / np.asarray(shape)).astype(np.float32)
+
+def extract_patches(volumes, patch, stride=None, copy=True):
+    ''' every patch on the grid for every volume in volumes (N, depth, H, W[, C]), returns patches and origins (P, 3) of each patch in depth, H, W
+        copy=True gives patches as (N, P, pd, ph, pw[, C]), gathered in one strided copy
+        copy=False gives a view onto volumes shaped (N, nd, nh, nw, pd, ph, pw[, C]) (grid axes separate), origins are in the same nd, nh, nw order
+        extract_patches(images, (16, 32, 32), (8, 16, 16)) '''
+    stride = patch if stride is None else stride
+    windows = sliding_window_view(volumes, tuple(patch), axis=(1, 2, 3)) # N, nd, nh, nw, [C,] pd, ph, pw
+    windows = windows[:, ::stride[0], ::stride[1], ::stride[2]]
+    if volumes.ndim == 5: # move channels back to the end
+        windows = np.moveaxis(windows, 4, -1)
+    origins = patch_grid(volumes.shape[1:4], patch, stride)
+    if not copy:
+        return windows, origins
+    n, nd, nh, nw = windows.shape[:4]
+    return windows.reshape((n, nd * nh * nw) + windows.shape[4:]), origins
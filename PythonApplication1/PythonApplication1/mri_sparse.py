@@ -0,0 +1,105 @@
+import os
+import json
+import numpy as np
+## Block-sparse cohorts
+## Cached volumes cut into blocks (8*8*8 by default), only blocks with a non-zero voxel are stored, the background outside the brain isn't kept at all ##
+## occupancy.npy says which blocks each subject has, blocks.npy holds them one subject after the other so a subject is one sequential (memory-mapped) read ##
+## BlockCohort looks like the dense array (shape, indexing, np.asarray) and rebuilds only the subjects that are indexed ##
+# Functions in this script:
+#   BlockCohort, save_blocks, load_blocks
+#   images = save_blocks(entry, images); print(images.occupied, images.nbytes / images.dense_nbytes)
+
+class BlockCohort:
+    ''' blocks (K, bd, bh, bw[, C]), occupancy (N, nd, nh, nw) bool and offsets (N + 1) into blocks per subject, for a cohort of shape
+        images[idx] gives dense volumes, zeros where there was no block '''
+    def __init__(self, blocks, occupancy, offsets, shape):
+        self.blocks = blocks
+        self.occupancy = occupancy
+        self.offsets = offsets
+        self.shape = tuple(shape)
+        self.block = tuple(blocks.shape[1:4])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.blocks.dtype
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes + self.occupancy.nbytes + self.offsets.nbytes
+
+    @property
+    def dense_nbytes(self):
+        return int(np.prod(self.shape)) * self.blocks.dtype.itemsize
+
+    @property
+    def occupied(self):
+        ''' fraction of blocks stored '''
+        return float(self.occupancy.mean())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def subject(self, i):
+        ''' one dense depth, H, W[, C] volume '''
+        grid = self.occupancy.shape[1:]
+        padded = np.zeros(tuple(g * b for g, b in zip(grid, self.block)) + self.shape[4:], dtype=self.dtype)
+        tiles = padded.reshape((grid[0], self.block[0], grid[1], self.block[1], grid[2], self.block[2]) + self.shape[4:])
+        d, h, w = np.nonzero(self.occupancy[i])
+        tiles[d, :, h, :, w] = self.blocks[self.offsets[i]:self.offsets[i + 1]] # one contiguous read
+        return padded[:self.shape[1], :self.shape[2], :self.shape[3]]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple): # images[i, d:d + p, ...] rebuilds subject(s) i then slices
+            return self[key[0]][(slice(None),) * np.ndim(key[0]) + key[1:]] if len(key) > 1 else self[key[0]]
+        subjects = np.arange(len(self))[key]
+        if np.ndim(subjects) == 0:
+            return self.subject(int(subjects))
+        return np.stack([self.subject(int(i)) for i in subjects]) if len(subjects) else np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+def _tiles(volume, block):
+    ''' volume (depth, H, W[, C]) zero-padded to whole blocks, as (nd, nh, nw, bd, bh, bw[, C]) '''
+    grid = [-(-s // b) for s, b in zip(volume.shape[:3], block)]
+    padded = np.zeros(tuple(g * b for g, b in zip(grid, block)) + volume.shape[3:], dtype=volume.dtype)
+    padded[:volume.shape[0], :volume.shape[1], :volume.shape[2]] = volume
+    tiles = padded.reshape((grid[0], block[0], grid[1], block[1], grid[2], block[2]) + volume.shape[3:])
+    return np.moveaxis(tiles, (1, 3), (3, 4)) # nd, nh, nw, bd, bh, bw[, C]
+
+def _occupied(tiles):
+    ''' (nd, nh, nw) bool, blocks with any non-zero voxel '''
+    return np.any(tiles.reshape(tiles.shape[:3] + (-1,)) != 0, axis=-1)
+
+def save_blocks(folder, images, block=(8, 8, 8), name='images'):
+    ''' writes images (N, depth, H, W[, C], e.g. the memory-mapped cache entry) as name_blocks.npy / name_occupancy.npy / name_blocks.json into folder
+        two passes one subject at a time (count the occupied blocks, then write them), returns the memory-mapped BlockCohort '''
+    block = tuple(block)
+    base = os.path.join(folder, name)
+    occupancy = np.stack([_occupied(_tiles(np.asarray(v), block)) for v in images])
+    offsets = np.concatenate([[0], np.cumsum(occupancy.reshape(len(images), -1).sum(axis=1))]).astype(np.int64)
+    blocks = np.lib.format.open_memmap(base + '_blocks.npy.tmp', mode='w+', dtype=images.dtype, shape=(int(offsets[-1]),) + block + tuple(images.shape[4:]))
+    for i, v in enumerate(images):
+        blocks[offsets[i]:offsets[i + 1]] = _tiles(np.asarray(v), block)[occupancy[i]]
+    blocks.flush()
+    del blocks # close the memmap before it's renamed
+    os.replace(base + '_blocks.npy.tmp', base + '_blocks.npy')
+    np.save(base + '_occupancy.npy', occupancy)
+    with open(base + '_blocks.json', 'w') as f: # written last, blocks without one are an unfinished save
+        json.dump({'shape': list(images.shape), 'block': list(block), 'offsets': offsets.tolist(), 'occupied': float(occupancy.mean())}, f)
+    return load_blocks(folder, name)
+
+def load_blocks(folder, name='images', mmap=True):
+    ''' the BlockCohort saved by save_blocks, None if there isn't one '''
+    base = os.path.join(folder, name)
+    if not os.path.exists(base + '_blocks.json'):
+        return None
+    with open(base + '_blocks.json') as f:
+        info = json.load(f)
+    return BlockCohort(np.load(base + '_blocks.npy', mmap_mode='r' if mmap else None), np.load(base + '_occupancy.npy'),
+                       np.asarray(info['offsets'], dtype=np.int64), info['shape'])
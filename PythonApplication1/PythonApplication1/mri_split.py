@@ -0,0 +1,89 @@
+import os
+import numpy as np
+## Splitting
+## Train/test (and k-fold) splits as index arrays over the one cohort array or memmap, saved so every run and the analysis scripts use the same partition ##
+## CohortView stands in for x_train/x_test without copying, rows are only gathered when a batch (or slice) is asked for ##
+# Functions in this script:
+#   make_split, make_folds, save_split, load_split, split_or_load, CohortView
+
+def make_split(labels, test_size=0.2, random_state=13, stratify=False):
+    ''' train and test indices, the same partition train_test_split(images, labels, test_size, random_state) gave (it only shuffles positions) '''
+    from sklearn.model_selection import train_test_split
+    index = np.arange(len(labels))
+    train_idx, test_idx = train_test_split(index, test_size=test_size, random_state=random_state, stratify=labels if stratify else None)
+    return train_idx, test_idx
+
+def make_folds(labels, k=5, random_state=13, stratify=True):
+    ''' list of k (train indices, test indices) pairs '''
+    from sklearn.model_selection import KFold, StratifiedKFold
+    folder = StratifiedKFold(k, shuffle=True, random_state=random_state) if stratify else KFold(k, shuffle=True, random_state=random_state)
+    return [(train, test) for train, test in folder.split(np.zeros(len(labels)), labels)]
+
+def save_split(path, train_idx, test_idx, folds=None, **info):
+    ''' saves the indices (and any folds) to an .npz, info is stored alongside (test_size, random_state...) '''
+    arrays = {'train': np.asarray(train_idx), 'test': np.asarray(test_idx)}
+    for i, (train, test) in enumerate(folds or []):
+        arrays['fold%d_train' % i] = np.asarray(train)
+        arrays['fold%d_test' % i] = np.asarray(test)
+    for name, value in info.items():
+        arrays['info_' + name] = np.asarray(value)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(path, **arrays)
+
+def load_split(path):
+    ''' returns train indices, test indices, folds (list, empty if none were saved) and the info dict '''
+    with np.load(path) as f:
+        folds = []
+        while 'fold%d_train' % len(folds) in f:
+            folds.append((f['fold%d_train' % len(folds)], f['fold%d_test' % len(folds)]))
+        info = {name[5:]: f[name].item() for name in f.files if name.startswith('info_')}
+        return f['train'], f['test'], folds, info
+
+def split_or_load(path, labels, test_size=0.2, random_state=13, stratify=False, k=None):
+    ''' loads the saved split if it was made for the same number of subjects and settings, otherwise makes and saves a new one
+        k adds k folds as well, returns train indices, test indices and folds '''
+    if os.path.exists(path):
+        train_idx, test_idx, folds, info = load_split(path)
+        if info.get('n') == len(labels) and info.get('test_size') == test_size and info.get('random_state') == random_state and info.get('stratify') == stratify and len(folds) == (k or 0):
+            return train_idx, test_idx, folds
+        print('split settings changed, making a new one at', path)
+    train_idx, test_idx = make_split(labels, test_size, random_state, stratify)
+    folds = make_folds(labels, k, random_state, stratify) if k else []
+    save_split(path, train_idx, test_idx, folds, n=len(labels), test_size=test_size, random_state=random_state, stratify=stratify)
+    return train_idx, test_idx, folds
+
+class CohortView:
+    ''' the rows of images given by indices, looks like the x_train/x_test array (len, shape, indexing) but doesn't copy
+        view[i] is subject indices[i], slices and index arrays gather just those rows, np.asarray(view) copies the whole subset '''
+    def __init__(self, images, indices):
+        self.images = images
+        self.indices = np.asarray(indices)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + tuple(self.images.shape[1:])
+
+    @property
+    def ndim(self):
+        return self.images.ndim
+
+    @property
+    def dtype(self):
+        return self.images.dtype
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple): # view[i, j] is view[i][j]
+            return self[key[0]][key[1:]] if len(key) > 1 else self[key[0]]
+        return self.images[self.indices[key]]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.images[self.indices]
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def batches(self, batch_size):
+        ''' yields consecutive batches, each gathered as it's needed '''
+        for start in range(0, len(self.indices), batch_size):
+            yield self[start:start + batch_size]
@@ -0,0 +1,131 @@
+import os
+import json
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from mri_loader import load_subject
+## Normalisation statistics
+## Cohort min/max, mean/std and percentiles worked out one subject at a time (partial reductions merged together), so nothing has to be fully in memory ##
+## Stats are saved as a small json next to the model so new subjects get normalised the same way as the training cohort ##
+# Functions in this script:
+#   partial_stats, merge_stats, finish_stats, cohort_stats, array_stats, normalise, subject_zscore, save_stats, load_stats
+
+def partial_stats(x, mask=None, edges=None):
+    ''' reduction of one subject: count, mean, m2 (sum of squared deviations), min, max and a histogram if edges are given, mask keeps only those voxels '''
+    x = np.asarray(x, dtype=np.float64)
+    vals = x[mask] if mask is not None else x.ravel()
+    part = {'count': vals.size, 'mean': float(vals.mean()) if vals.size else 0., 'm2': float(((vals - vals.mean()) ** 2).sum()) if vals.size else 0.,
+            'min': float(vals.min()) if vals.size else np.inf, 'max': float(vals.max()) if vals.size else -np.inf}
+    if edges is not None:
+        part['hist'] = np.histogram(np.clip(vals, edges[0], edges[-1]), edges)[0]
+    return part
+
+def merge_stats(a, b):
+    ''' combines two partial_stats (parallel variance formula), either can be None '''
+    if a is None or a['count'] == 0:
+        return b
+    if b is None or b['count'] == 0:
+        return a
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    merged = {'count': count, 'mean': a['mean'] + delta * b['count'] / count,
+              'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count,
+              'min': min(a['min'], b['min']), 'max': max(a['max'], b['max'])}
+    if 'hist' in a:
+        merged['hist'] = a['hist'] + b['hist']
+    return merged
+
+def finish_stats(merged, edges=None, percentiles=()):
+    ''' turns merged partials into the stats dict that gets saved, percentiles are read off the histogram (accurate to one bin width) '''
+    stats = {'count': int(merged['count']), 'min': merged['min'], 'max': merged['max'], 'mean': merged['mean'],
+             'std': float(np.sqrt(merged['m2'] / merged['count'])), 'percentiles': {}}
+    if percentiles:
+        cdf = np.cumsum(merged['hist']) / merged['hist'].sum()
+        for p in percentiles:
+            stats['percentiles'][str(p)] = float(edges[min(np.searchsorted(cdf, p / 100.) + 1, len(edges) - 1)])
+    return stats
+
+def _subject_partial(path, mask_path, slab, crop, mask_threshold, edges):
+    x = load_subject(path, slab, crop, proxy=True, dtype=np.float32)
+    mask = None if mask_path is None else load_subject(mask_path, slab, crop, proxy=True, dtype=np.float32) > mask_threshold
+    return partial_stats(x, mask, edges)
+
+def _map_partials(paths, mask_paths, slab, crop, mask_threshold, edges, workers):
+    ''' merged partial_stats over every file, in a process pool '''
+    merged = None
+    if workers <= 1:
+        parts = map(_subject_partial, paths, mask_paths, repeat(slab), repeat(crop), repeat(mask_threshold), repeat(edges))
+        for part in parts:
+            merged = merge_stats(merged, part)
+        return merged
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for part in ex.map(_subject_partial, paths, mask_paths, repeat(slab), repeat(crop), repeat(mask_threshold), repeat(edges), chunksize=max(1, len(paths) // (workers * 4))):
+            merged = merge_stats(merged, part) # merged as they come in, only one partial per worker is held at a time
+    return merged
+
+def cohort_stats(filepath_df, num_subjs, mri_type='wp1', slab=(101, 117), crop=((20, 60), (50, 90)), mask_type=None, mask_threshold=0.5, percentiles=(), bins=10000, workers=None):
+    ''' streaming stats straight from the niftis, one subject per worker at a time, never loads the cohort
+        mask_type ('rp1' or 'rp2') restricts the stats to voxels where the mask is over mask_threshold, percentiles e.g. (1, 99) needs a second pass for the histogram
+        cohort_stats(filepath_df, 698, 'wp1', percentiles=(1, 99), workers=8) '''
+    rows = filepath_df.iloc[:num_subjs]
+    paths = list(rows[mri_type])
+    mask_paths = list(rows[mask_type]) if mask_type is not None else [None] * len(paths)
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    merged = _map_partials(paths, mask_paths, slab, crop, mask_threshold, None, workers)
+    edges = None
+    if percentiles:
+        edges = np.linspace(merged['min'], merged['max'], bins + 1)
+        merged = _map_partials(paths, mask_paths, slab, crop, mask_threshold, edges, workers)
+    return finish_stats(merged, edges, percentiles)
+
+def array_stats(images, masks=None, percentiles=(), bins=10000, mask_threshold=0.5):
+    ''' the same stats over an already loaded (or memory-mapped) cohort array, reduced one subject row at a time, masks is an optional array of mask volumes the same shape '''
+    def merged_over(edges):
+        merged = None
+        for i in range(len(images)):
+            merged = merge_stats(merged, partial_stats(images[i], None if masks is None else masks[i] > mask_threshold, edges))
+        return merged
+    merged = merged_over(None)
+    edges = None
+    if percentiles:
+        edges = np.linspace(merged['min'], merged['max'], bins + 1)
+        merged = merged_over(edges)
+    return finish_stats(merged, edges, percentiles)
+
+def normalise(images, stats, method='minmax', percentiles=(1, 99)):
+    ''' normalises images in place with cohort stats
+        minmax rescales to 0-1, zscore to mean 0 sd 1, robust rescales the percentiles range to 0-1 and clips outside it (needs the percentiles in stats) '''
+    if method == 'minmax':
+        lo, hi = stats['min'], stats['max']
+    elif method == 'robust':
+        lo, hi = stats['percentiles'][str(percentiles[0])], stats['percentiles'][str(percentiles[1])]
+    elif method == 'zscore':
+        images -= stats['mean']
+        images /= stats['std']
+        return images
+    else:
+        raise ValueError('unknown normalisation ' + str(method))
+    images -= lo
+    images /= (hi - lo)
+    if method == 'robust':
+        np.clip(images, 0, 1, out=images)
+    return images
+
+def subject_zscore(images, masks, mask_threshold=0.5):
+    ''' z-scores each subject in place using the mean and sd of its own in-mask voxels (rp1/rp2 loaded the same way as images), needs no cohort stats '''
+    for i in range(len(images)):
+        vals = images[i][masks[i] > mask_threshold]
+        if vals.size:
+            images[i] -= vals.mean()
+            images[i] /= (vals.std() or 1.)
+    return images
+
+def save_stats(stats, model_dir, name='normalisation.json'):
+    ''' writes the stats next to the model weights '''
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, name), 'w') as f:
+        json.dump(stats, f, indent=1)
+
+def load_stats(model_dir, name='normalisation.json'):
+    with open(os.path.join(model_dir, name)) as f:
+        return json.load(f)
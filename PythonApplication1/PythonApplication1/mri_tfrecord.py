@@ -0,0 +1,99 @@
+import os
+import json
+import glob
+import hashlib
+import numpy as np
+import tensorflow as tf
+## TFRecords
+## Exports the preprocessed cohort (images, labels, subject ids) to sharded TFRecord files once, then trains from those with parallel interleaved reads ##
+## Shards are sized for parallel reading (default ~100MB, at least min_shards of them), optionally GZIP compressed, a meta.json records shape and config ##
+## Each worker of a multi-process run can read a disjoint set of shards (num_workers, worker_index) ##
+# Functions in this script:
+#   write_tfrecords, export_tfrecords, tfrecord_dataset
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+def _example(image, label, subject_id):
+    feature = {'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[np.ascontiguousarray(image, dtype=np.float32).tobytes()])),
+               'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+               'subject': tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(subject_id).encode()]))}
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+def write_tfrecords(out_dir, images, labels, subject_ids=None, indices=None, prefix='train', shard_mb=100, min_shards=8, compression='GZIP', key=None):
+    ''' writes images[indices] (float32) with their labels and subject ids into prefix-00000-of-000NN.tfrecord shards in out_dir
+        shards hold about shard_mb of raw data, but the cohort is always split into at least min_shards so readers can work in parallel
+        write_tfrecords('C:/tfrecords', images, labels, indices=train_idx, prefix='train') '''
+    indices = np.arange(len(images)) if indices is None else np.asarray(indices)
+    subject_ids = [str(i) for i in range(len(images))] if subject_ids is None else list(subject_ids)
+    sample_bytes = int(np.prod(images.shape[1:])) * 4
+    per_shard = max(1, min(shard_mb * 2**20 // sample_bytes, int(np.ceil(len(indices) / min_shards))))
+    num_shards = int(np.ceil(len(indices) / per_shard))
+    os.makedirs(out_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(out_dir, prefix + '-*.tfrecord')): # a previous export with a different number of shards
+        os.remove(old)
+    options = tf.io.TFRecordOptions(compression_type=compression or '')
+    paths = []
+    for s in range(num_shards):
+        path = os.path.join(out_dir, '%s-%05d-of-%05d.tfrecord' % (prefix, s, num_shards))
+        with tf.io.TFRecordWriter(path, options) as writer:
+            for i in indices[s * per_shard:(s + 1) * per_shard]:
+                writer.write(_example(images[i], labels[i], subject_ids[i]))
+        paths.append(path)
+    meta = {'prefix': prefix, 'num_examples': len(indices), 'num_shards': num_shards, 'shape': list(images.shape[1:]),
+            'compression': compression, 'num_classes': int(max(labels)) + 1, 'key': key}
+    with open(os.path.join(out_dir, prefix + '_meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return paths
+
+def export_tfrecords(out_dir, images, labels, indices, prefix, key, subject_ids=None, **kwargs):
+    ''' write_tfrecords only if out_dir doesn't already hold this export, key should identify the cohort (e.g. cohort_key), the split indices are added to it
+        returns the meta dict '''
+    key = key + '-' + hashlib.sha1(np.asarray(indices, dtype=np.int64).tobytes()).hexdigest()[:8]
+    meta_path = os.path.join(out_dir, prefix + '_meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('key') == key:
+            return meta
+    write_tfrecords(out_dir, images, labels, subject_ids, indices, prefix, key=key, **kwargs)
+    with open(meta_path) as f:
+        return json.load(f)
+
+def tfrecord_dataset(out_dir, prefix='train', batch_size=8, num_classes=None, shuffle=True, seed=13, shuffle_buffer=256, cycle_length=None, num_workers=1, worker_index=0, with_ids=False):
+    ''' reads the shards back as ((image, onehot label), image) batches for cvae.fit, shards are interleaved and read in parallel
+        num_workers/worker_index gives each worker process its own disjoint shards
+        with_ids=True returns (dataset, subject ids) instead, the ids in the order the unshuffled dataset's subjects come out (e.g. to go with cvae.predict's rows)
+        they're kept out of the batches, a third element would be taken as a sample weight by fit / evaluate '''
+    if with_ids and shuffle:
+        raise ValueError('with_ids needs shuffle=False, the ids only line up with the subjects in a fixed order')
+    with open(os.path.join(out_dir, prefix + '_meta.json')) as f:
+        meta = json.load(f)
+    shape = meta['shape']
+    num_classes = meta['num_classes'] if num_classes is None else num_classes
+    files = sorted(glob.glob(os.path.join(out_dir, prefix + '-*-of-%05d.tfrecord' % meta['num_shards'])))
+    files = tf.data.Dataset.from_tensor_slices(files)
+    if num_workers > 1:
+        files = files.shard(num_workers, worker_index)
+    if shuffle:
+        files = files.shuffle(meta['num_shards'], seed=seed, reshuffle_each_iteration=True)
+    compression = meta['compression'] or ''
+    ds = files.interleave(lambda path: tf.data.TFRecordDataset(path, compression_type=compression),
+                          cycle_length=cycle_length or min(meta['num_shards'], os.cpu_count() or 1), num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    features = {'image': tf.io.FixedLenFeature([], tf.string), 'label': tf.io.FixedLenFeature([], tf.int64), 'subject': tf.io.FixedLenFeature([], tf.string)}
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, features)
+        x = tf.reshape(tf.io.decode_raw(example['image'], tf.float32), shape)
+        if len(shape) == 3: # single modality, add the channel axis
+            x = tf.expand_dims(x, -1)
+        y = tf.one_hot(example['label'], num_classes)
+        return (x, y), x
+
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True) # records from several shards mix here
+    batches = ds.map(parse, num_parallel_calls=AUTOTUNE).batch(batch_size).prefetch(AUTOTUNE)
+    if with_ids: # one read of the same records in the same order, only the subject field parsed
+        subject = {'subject': features['subject']}
+        ids = [s.decode() for s in ds.map(lambda record: tf.io.parse_single_example(record, subject)['subject']).as_numpy_iterator()]
+        return batches, ids
+    return batches
@@ -0,0 +1,4 @@
+import os
+import sys
+# the modules are scripts in the folder above, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
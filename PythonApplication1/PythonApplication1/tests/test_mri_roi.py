@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+import mri_loader
+from mri_roi import bounding_box, mask_box, volume_shape
+
+def test_bounding_box_around_every_subject():
+    volumes = np.zeros((3, 8, 10, 12), dtype=np.float32)
+    volumes[0, 2, 3, 4] = 1.
+    volumes[2, 5, 7, 9] = 1. # subject 1 is empty and doesn't count
+    assert bounding_box(volumes) == ((2, 6), (3, 8), (4, 10))
+
+def test_bounding_box_all_empty_is_the_whole_volume():
+    volumes = np.zeros((3, 8, 10, 12), dtype=np.float32)
+    assert bounding_box(volumes) == ((0, 8), (0, 10), (0, 12))
+    assert bounding_box(volumes, multiple=4) == ((0, 8), (1, 9), (0, 12))
+
+def test_mask_box_all_empty_masks(monkeypatch):
+    monkeypatch.setattr(mri_loader, 'load_subject', lambda path, slab, crop, proxy: np.zeros(volume_shape, dtype=np.float32))
+    filepath_df = pd.DataFrame({'rp1': ['a.nii', 'b.nii'], 'rp2': ['c.nii', 'd.nii']})
+    assert mask_box(filepath_df, 2, margin=2, multiple=8, workers=2) == ((0, 144), (0, 120), (0, 120))
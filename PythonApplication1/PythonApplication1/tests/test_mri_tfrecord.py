@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from mri_tfrecord import write_tfrecords, tfrecord_dataset
+
+def _cohort(tmp_path, n=10):
+    images = np.arange(n, dtype=np.float32)[:, None, None, None] * np.ones((n, 2, 3, 3), dtype=np.float32) # subject i is all i
+    labels = [i % 3 for i in range(n)]
+    write_tfrecords(str(tmp_path), images, labels, subject_ids=['subj%02d' % i for i in range(n)], min_shards=4)
+    return images, labels
+
+def test_with_ids_keeps_ids_out_of_the_batches(tmp_path):
+    _cohort(tmp_path)
+    ds, ids = tfrecord_dataset(str(tmp_path), batch_size=4, shuffle=False, with_ids=True)
+    batches = list(ds.as_numpy_iterator())
+    assert all(len(batch) == 2 for batch in batches) # ((x, y), x), nothing fit could take as a sample weight
+    seen = np.concatenate([x[:, 0, 0, 0, 0] for (x, _), _ in batches])
+    assert ids == ['subj%02d' % int(v) for v in seen]
+    assert sorted(ids) == ['subj%02d' % i for i in range(10)]
+
+def test_with_ids_needs_a_fixed_order(tmp_path):
+    _cohort(tmp_path)
+    with pytest.raises(ValueError):
+        tfrecord_dataset(str(tmp_path), shuffle=True, with_ids=True)
+
+def test_without_ids_unchanged(tmp_path):
+    _cohort(tmp_path)
+    (x, y), target = next(iter(tfrecord_dataset(str(tmp_path), batch_size=4, num_classes=3, shuffle=False)))
+    assert x.shape == (4, 2, 3, 3, 1) and y.shape == (4, 3)
+    np.testing.assert_array_equal(x, target)
@@ -0,0 +1,179 @@
+import sys
+import os
+import json
+import socket
+import argparse
+import subprocess
+import numpy as np
+## Data-parallel training on one multi-core machine
+## Starts --workers local processes that train the MRI CVAE together with MultiWorkerMirroredStrategy over localhost (gradients all-reduced with a ring collective) ##
+## Each worker is pinned to its own set of cores with a matching intra-op thread count, so workers don't fight over cores, and reads its own equal share of the training subjects ##
+## --batch_size is per worker (the global batch grows with --workers), only worker 0 reports and saves ##
+## --scaling 1,2,4,8 runs the launcher once per worker count and prints throughput, speedup and scaling efficiency ##
+# run: python train_parallel.py --workers 4                                  (synthetic cohort, e.g. to check scaling)
+#      python train_parallel.py --workers 8 --cache_dir C:/Users/Mischa/sophie/cohort_cache --key <cache key> --split C:/Users/Mischa/sophie/models/MRI_CVAE/split.npz --model_dir C:/Users/Mischa/sophie/models/MRI_CVAE_parallel
+#      python train_parallel.py --scaling 1,2,4,8 --cores_per_worker 8
+
+def free_ports(n):
+    ''' n ports nothing on localhost is listening on '''
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def core_sets(num_workers, cores_per_worker=None):
+    ''' consecutive, non-overlapping core ids for each worker, all cores split evenly by default '''
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    per = cores_per_worker or max(1, len(cores) // num_workers)
+    if per * num_workers > len(cores):
+        print('warning: %d workers * %d cores is more than the %d available, cores are shared' % (num_workers, per, len(cores)))
+    return [[cores[(w * per + i) % len(cores)] for i in range(per)] for w in range(num_workers)]
+
+def pin(cores):
+    ''' keeps this process on cores, has to happen before tensorflow starts its thread pools '''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    else:
+        try:
+            import psutil # windows
+            psutil.Process().cpu_affinity(cores)
+        except ImportError:
+            print('psutil is needed to pin workers on this platform, running unpinned')
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+
+def keras3_multi_worker(cvae):
+    ''' works around two places keras 3's fit can't handle MultiWorkerMirroredStrategy, nothing changes on tf.keras 2
+        fit builds the optimizer by reducing the first batch across replicas (_maybe_symbolic_build, a nested batch fails PerReplica to Tensor), so it's built here
+        under the strategy scope and that step is skipped (build_cvae already built the model), and the logs are reduced with a mean over axis 0,
+        which scalar losses don't have, so the steps give them as shape (1,) and they come back as scalars '''
+    import tensorflow as tf
+    if not hasattr(cvae, '_maybe_symbolic_build'): # tf.keras 2
+        return
+    cvae.optimizer.build(cvae.trainable_variables)
+    cvae._maybe_symbolic_build = lambda iterator=None, data_batch=None: None
+    for name in ('train_step', 'test_step'):
+        step = getattr(cvae, name)
+        setattr(cvae, name, lambda data, step=step: {k: tf.reshape(v, (1,)) for k, v in step(data).items()})
+
+def worker(args):
+    ''' one worker process, TF_CONFIG (set by launch) says which one '''
+    task = json.loads(os.environ['TF_CONFIG'])['task']['index']
+    pin([int(c) for c in args.cores.split(',')])
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(args.cores.split(',')))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    from mri_cvae_model import build_cvae, training_mode
+    from mri_pipeline import cohort_dataset
+    from benchmark_common import timer, samples_per_s
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options=tf.distribute.experimental.CommunicationOptions(implementation=tf.distribute.experimental.CommunicationImplementation.RING))
+
+    if args.cache_dir:
+        from mri_cache import open_cached
+        from mri_split import load_split
+        images, labels = open_cached(args.cache_dir, args.key, quantise=args.quantise, sparse=args.sparse and (args.sparse,) * 3)
+        train_idx, test_idx, _, _ = load_split(args.split)
+    else:
+        from benchmark_common import synthetic_cohort
+        images, labels = synthetic_cohort(args.synthetic, (16, 40, 40))
+        train_idx, test_idx = np.arange(len(images))[:int(len(images) * 0.8)], np.arange(len(images))[int(len(images) * 0.8):]
+    n_y = int(max(labels)) + 1
+
+    def shard(indices, worker): # every worker gets the same number of subjects, so they all run the same number of steps
+        per = len(indices) // args.workers
+        return indices[worker * per:(worker + 1) * per]
+
+    def datasets(indices, shuffle): # from a function, so batch_size is what each worker gets (a plain dataset's batch would be split across the workers)
+        def dataset_fn(context):
+            worker = context.input_pipeline_id
+            # repeated, fit is given the steps (a distributed dataset's length isn't known), one pass over the shard per epoch
+            return cohort_dataset(images, labels, args.batch_size, num_classes=n_y, shuffle=shuffle, seed=13 + worker, indices=shard(indices, worker)).repeat()
+        return strategy.distribute_datasets_from_function(dataset_fn)
+    train_ds, val_ds = datasets(train_idx, True), datasets(test_idx, False)
+    steps = lambda indices: -(-len(shard(indices, 0)) // args.batch_size) # batches in one worker's shard
+
+    shape = images.shape[1:4]
+    model_config = {'depth': shape[0], 'rows': shape[1], 'cols': shape[2], 'inchannel': images.shape[4] if images.ndim == 5 else 1, 'n_y': n_y,
+                    'latent_dim': args.latent_dim, 'learning_rate': args.learning_rate}
+    with strategy.scope():
+        models = build_cvae(**model_config, accumulate_steps=args.accumulate_steps, summary=False, **training_mode(args.mode))
+        keras3_multi_worker(models['cvae'])
+    epoch_timer = timer('epoch')
+    history = models['cvae'].fit(train_ds, epochs=args.epochs, steps_per_epoch=steps(train_idx), validation_data=val_ds, validation_steps=steps(test_idx),
+                                 verbose=2 if task == 0 else 0, callbacks=[epoch_timer])
+    if task != 0:
+        return
+    if args.model_dir:
+        from mri_registry import save_run
+        save_run(args.model_dir, models, {'data': {'cache_dir': args.cache_dir, 'cache_key': args.key, 'quantise': args.quantise, 'sparse': args.sparse and [args.sparse] * 3}, 'model': model_config,
+                                          'train': {'epochs': args.epochs, 'batch_size': args.batch_size, 'accumulate_steps': args.accumulate_steps, 'workers': args.workers}}, history)
+    print(json.dumps({'workers': args.workers, 'cores_per_worker': len(args.cores.split(',')), 'global_batch': args.batch_size * args.workers,
+                      'samples_per_s': samples_per_s(epoch_timer.times, len(shard(train_idx, 0)) * args.workers), 'final_val_loss': history.history['val_loss'][-1]})) # the first epoch (tracing, setting up the collectives) left out
+
+def launch(args):
+    ''' starts args.workers worker processes on localhost and returns worker 0's result '''
+    ports = free_ports(args.workers)
+    cluster = {'worker': ['localhost:%d' % p for p in ports]}
+    procs = []
+    for task, cores in enumerate(core_sets(args.workers, args.cores_per_worker)):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': task}}))
+        cmd = [sys.executable, os.path.abspath(__file__), '--cores', ','.join(map(str, cores))]
+        for name in ('workers', 'epochs', 'batch_size', 'accumulate_steps', 'latent_dim', 'learning_rate', 'mode', 'synthetic', 'cache_dir', 'key', 'quantise', 'sparse', 'split', 'model_dir'):
+            if getattr(args, name) is not None:
+                cmd += ['--' + name, str(getattr(args, name))]
+        procs.append(subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE if task == 0 else subprocess.DEVNULL, text=True))
+    out, _ = procs[0].communicate()
+    for p in procs[1:]:
+        p.wait()
+    if any(p.returncode for p in procs):
+        raise RuntimeError('a worker failed, return codes %s' % [p.returncode for p in procs])
+    return json.loads(out.strip().splitlines()[-1])
+
+def scaling(args):
+    ''' runs launch for each worker count, efficiency is throughput / (workers * single worker throughput) '''
+    import pandas as pd
+    counts = [int(c) for c in args.scaling.split(',')]
+    per = args.cores_per_worker or max(1, (os.cpu_count() or 1) // max(counts)) # same cores per worker in every run
+    results = []
+    for count in counts:
+        results.append(launch(argparse.Namespace(**dict(vars(args), workers=count, cores_per_worker=per))))
+        print(results[-1])
+    results = pd.DataFrame(results).set_index('workers')
+    base = results['samples_per_s'].iloc[0] / results.index[0]
+    results['speedup'] = results['samples_per_s'] / results['samples_per_s'].iloc[0]
+    results['efficiency'] = results['samples_per_s'] / (results.index * base)
+    print(results.round(3).to_string())
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--cores_per_worker', type=int, default=None)
+    parser.add_argument('--scaling', default=None, help='comma separated worker counts, e.g. 1,2,4,8')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=8, help='per worker')
+    parser.add_argument('--accumulate_steps', type=int, default=1, help='micro-batches per worker batch')
+    parser.add_argument('--latent_dim', type=int, default=50)
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+    parser.add_argument('--mode', default='float32', help='training_mode, float32 / xla / bf16 / xla_bf16')
+    parser.add_argument('--synthetic', type=int, default=256, help='synthetic subjects if no --cache_dir')
+    parser.add_argument('--cache_dir', default=None)
+    parser.add_argument('--key', default=None, help='cohort cache key, e.g. from run.json of a saved run')
+    parser.add_argument('--quantise', default=None, help='uint8 or float16, train from a quantised copy of the cached cohort')
+    parser.add_argument('--sparse', type=int, default=None, help='block size, train from a block-sparse copy of the cached cohort')
+    parser.add_argument('--split', default=None, help='split.npz with the train/test indices')
+    parser.add_argument('--model_dir', default=None, help='worker 0 saves the run here')
+    parser.add_argument('--cores', default=None, help=argparse.SUPPRESS) # set by launch, makes this a worker
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cores is not None:
+        worker(args)
+    elif args.scaling:
+        scaling(args)
+    else:
+        print(launch(args))
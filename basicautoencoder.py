@@ -1,36 +1,23 @@
 import keras
 from matplotlib import pyplot as plt
 import numpy as np
-import gzip
 from keras.layers import Input,Conv2D,MaxPooling2D,UpSampling2D
 from keras.models import Model
 from keras.optimizers import RMSprop
 import os, sys
+import importlib.util
+# the shared MNIST loader is in the project folder, loaded from its file (this script stays where it was, outside the project)
+spec = importlib.util.spec_from_file_location('mnist_data', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PythonApplication1', 'PythonApplication1', 'mnist_data.py'))
+mnist_data = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mnist_data)
+load_mnist, mnist_dataset, scale_batch = mnist_data.load_mnist, mnist_data.mnist_dataset, mnist_data.scale_batch
 
 import os
 os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"]="0" #model will be trained on GPU 1
 
-def extract_data(filename, num_images):
-    with gzip.open(filename) as bytestream:
-        bytestream.read(16)
-        buf = bytestream.read(28 * 28 * num_images)
-        data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-        data = data.reshape(num_images, 28,28)
-        return data
-
-train_data = extract_data('C:/Users/Mischa/Documents/Uni Masters/Diss project/Practise/train-images-idx3-ubyte.gz', 60000)
-test_data = extract_data('C:/Users/Mischa/Documents/Uni Masters/Diss project/Practise/t10k-images-idx3-ubyte.gz', 10000)
-
-def extract_labels(filename, num_images):
-    with gzip.open(filename) as bytestream:
-        bytestream.read(8)
-        buf = bytestream.read(1 * num_images)
-        labels = np.frombuffer(buf, dtype=np.uint8).astype(np.int64)
-        return labels
-
-train_labels = extract_labels('C:/Users/Mischa/Documents/Uni Masters/Diss project/Practise/train-labels-idx1-ubyte.gz',60000)
-test_labels = extract_labels('C:/Users/Mischa/Documents/Uni Masters/Diss project/Practise/t10k-labels-idx1-ubyte.gz',10000)
+# the .gz files are only decompressed on the first run, after that the cached IDX files are memory mapped (uint8)
+(train_data, train_labels), (test_data, test_labels) = load_mnist('C:/Users/Mischa/Documents/Uni Masters/Diss project/Practise')
 
 # Shapes of training set
 print("Training set (images) shape: {shape}".format(shape=train_data.shape))
@@ -67,24 +54,17 @@ label_dict = {
 #plt.title("(Label: " + str(label_dict[curr_lbl]) + ")")
 
 
-train_data = train_data.reshape(-1, 28,28, 1)
-test_data = test_data.reshape(-1, 28,28, 1)
+# training batches are reshaped to 28, 28, 1 and scaled to between 0 and 1 as they're read, the test set is scaled once for predict and the plots
+test_data = scale_batch(test_data, (28, 28, 1))
 train_data.shape, test_data.shape
 
 train_data.dtype, test_data.dtype
 
-np.max(train_data), np.max(test_data)
-
-train_data = train_data / np.max(train_data)
-test_data = test_data / np.max(test_data)
-
-np.max(train_data), np.max(test_data)
-
 from sklearn.model_selection import train_test_split
-train_X,valid_X,train_ground,valid_ground = train_test_split(train_data,
-                                                             train_data, 
-                                                             test_size=0.2, 
-                                                             random_state=13)
+# splitting the indices gives the same partition as splitting the images
+train_idx, valid_idx = train_test_split(np.arange(len(train_data)),
+                                        test_size=0.2, 
+                                        random_state=13)
 
 batch_size = 128
 epochs = 5
@@ -114,7 +94,9 @@ autoencoder.compile(loss='mean_squared_error', optimizer = RMSprop())
 
 #autoencoder.summary()
 
-autoencoder_train = autoencoder.fit(train_X, train_ground, batch_size=batch_size,epochs=epochs,verbose=1,validation_data=(valid_X, valid_ground))
+train_ds = mnist_dataset(train_data, batch_size=batch_size, shape=(28, 28, 1), indices=train_idx)
+valid_ds = mnist_dataset(train_data, batch_size=batch_size, shape=(28, 28, 1), shuffle=False, indices=valid_idx)
+autoencoder_train = autoencoder.fit(train_ds,epochs=epochs,verbose=1,validation_data=valid_ds)
 
 #loss = autoencoder_train.history['loss']
 #val_loss = autoencoder_train.history['val_loss']